@@ -0,0 +1,146 @@
+"""
+This module provides `ADCTrace`, a compact container for the readings of one ADC channel.
+
+A Python float in a list costs ~32 bytes per sample. An `ADCTrace` keeps the raw 16 bit counts in growable numpy chunks (2 bytes per sample), and converts them to mV only when they are accessed: `trace[a:b]` converts just that slice, and `mV` converts chunk by chunk into an array of the requested type.
+"""
+import numpy as np
+from Calibration import lookup_table
+
+
+class ADCTrace():
+
+    def __init__(self, channel, sample_period=None, gain=1.0, offset=0.0, chunk=2**16):
+        """Makes a new, empty trace.
+
+        Parameters
+        ----------
+        channel : int
+            The ADC channel the readings come from
+
+        sample_period : float, optional
+            Seconds between two readings of this channel
+
+        gain : float, optional
+            Calibration gain applied after `FastDAC.map_int16_to_mV`
+
+        offset : float, optional
+            Calibration offset in mV applied after the gain
+
+        chunk : int, optional
+            The number of samples per storage chunk. The trace grows one chunk at a time, without copying what is already stored.
+        """
+        self.channel = channel
+        self.sample_period = sample_period
+        self.gain = gain
+        self.offset = offset
+        # the AcquisitionStats of the stream the readings came from, if any
+        self.stats = None
+        self.chunk = chunk
+        self._chunks = [np.empty(chunk, dtype=np.uint16)]
+        # number of samples in the last chunk
+        self._fill = 0
+
+    def __len__(self):
+        return (len(self._chunks) - 1)*self.chunk + self._fill
+
+    @property
+    def nbytes(self):
+        """The memory held by the trace in bytes"""
+        return len(self._chunks)*self.chunk*2
+
+    def append(self, raw):
+        """Appends raw samples, e.g. as yielded by `FastDAC.iter_channels`
+
+        Parameters
+        ----------
+        raw : numpy array
+            Raw 16 bit counts, of any byte order
+        """
+        start = 0
+        while start < len(raw):
+            if self._fill == self.chunk:
+                self._chunks.append(np.empty(self.chunk, dtype=np.uint16))
+                self._fill = 0
+            n = min(len(raw) - start, self.chunk - self._fill)
+            self._chunks[-1][self._fill:self._fill + n] = raw[start:start + n]
+            self._fill += n
+            start += n
+
+    def raw(self):
+        """Returns all raw counts as one numpy uint16 array
+        """
+        return np.concatenate(self._chunks[:-1] + [self._chunks[-1][:self._fill]])
+
+    def _convert(self, raw, out):
+        """Converts raw counts to calibrated mV, written into out"""
+        if out.dtype == np.float64:
+            # imported here, as FastDAC imports this module
+            from FastDAC import FastDAC
+            return FastDAC.map_int16_to_mV_calibrated(raw, self.gain, self.offset, out=out)
+        return np.take(lookup_table(self.gain, self.offset, out.dtype), raw, out=out, mode="clip")
+
+    def _slice(self, start, stop, step):
+        """The raw counts of a slice with a positive step, gathered chunk by chunk"""
+        parts = list()
+        for k, chunk in enumerate(self._chunks):
+            lo = k*self.chunk
+            hi = min(stop, lo + (self._fill if k == len(self._chunks) - 1 else self.chunk))
+            # the first index of the slice at or after lo
+            first = start if start >= lo else start + -(-(lo - start) // step)*step
+            if first < hi:
+                parts.append(chunk[first - lo:hi - lo:step])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.uint16)
+
+    def __getitem__(self, index):
+        """Converts only the selected readings to calibrated mV
+
+        Parameters
+        ----------
+        index : int, slice or array of ints
+        """
+        n = len(self)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            if step > 0:
+                raw = self._slice(start, stop, step)
+            else:
+                m = len(range(start, stop, step))
+                raw = self._slice(start + (m - 1)*step, start + 1, -step)[::-1] if m else np.empty(0, dtype=np.uint16)
+        else:
+            positions = np.asarray(index)
+            positions = np.where(positions < 0, positions + n, positions)
+            if np.any((positions < 0) | (positions >= n)):
+                raise IndexError("index {} is out of bounds for a trace of {} readings".format(index, n))
+            if positions.ndim == 0:
+                raw = self._chunks[positions // self.chunk][positions % self.chunk]
+                return float(self._convert(np.array([raw]), np.empty(1))[0])
+            raw = np.empty(positions.shape, dtype=np.uint16)
+            which = positions // self.chunk
+            for k in np.unique(which):
+                selected = which == k
+                raw[selected] = self._chunks[k][positions[selected] - k*self.chunk]
+        return self._convert(raw, np.empty(len(raw)))
+
+    def mV(self, dtype=np.float64):
+        """Returns the readings converted to calibrated mV
+
+        Parameters
+        ----------
+        dtype : numpy dtype, optional
+            np.float32 halves the memory of the result. The readings are converted chunk by chunk straight into it, so no float64 copy is made.
+        """
+        out = np.empty(len(self), dtype=dtype)
+        for k, chunk in enumerate(self._chunks):
+            lo = k*self.chunk
+            n = self._fill if k == len(self._chunks) - 1 else self.chunk
+            self._convert(chunk[:n], out[lo:lo + n])
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return self.mV() if dtype is None else self.mV(dtype)
+
+    def time(self):
+        """Returns the time of every reading in seconds, relative to the first one
+        """
+        assert self.sample_period is not None, "The sample period of this trace is unknown"
+        return np.arange(len(self))*self.sample_period
@@ -0,0 +1,528 @@
+"""
+This module provides the building blocks that `FastDAC` uses to stream data off the serial port: a preallocated ring buffer and a reader thread that drains the serial port into it, and the `AcquisitionStats` that tell whether the host keeps up.
+
+The reader thread (the producer) never waits on anybody. Plotting, storage and spectral analysis (the consumers) each pull from the ring buffer through their own `RingCursor`, at their own pace.
+"""
+import os
+import time
+import select
+import threading
+import numpy as np
+import serial
+
+
+class RingBuffer():
+
+    def __init__(self, capacity, dtype=">u2"):
+        """Makes a new preallocated ring buffer.
+
+        One producer writes bytes into the buffer, and any number of consumers read whole items back through their own `RingCursor`. The producer never blocks; a consumer that falls more than `capacity` items behind loses the oldest items, and its cursor counts them as dropped.
+
+        Parameters
+        ----------
+        capacity : int
+            The number of items the buffer can hold
+
+        dtype : numpy dtype, optional
+            The type of one item. The default is a raw big endian ADC sample as sent by the FastDAC.
+        """
+        self.dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        self._data = np.zeros(self.capacity, dtype=self.dtype)
+        self._bytes = self._data.view(np.uint8)
+        self.nbytes = self._bytes.size
+        # a single write never covers more than a quarter of the buffer, so a
+        # consumer can tell which items a write in progress may be clobbering
+        self.max_write = max(self.dtype.itemsize,
+                             (self.nbytes // 4) // self.dtype.itemsize * self.dtype.itemsize)
+        self._guard = self.max_write // self.dtype.itemsize + 1
+        # total number of bytes ever written
+        self.written = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def items_written(self):
+        """The total number of complete items ever written"""
+        return self.written // self.dtype.itemsize
+
+    def write(self, data):
+        """Copies a bytes-like object into the buffer, wrapping around as needed
+
+        Parameters
+        ----------
+        data : bytes-like
+            Raw bytes. Items may be split across calls.
+        """
+        data = memoryview(data).cast("B")
+        for start in range(0, len(data), self.max_write):
+            block = data[start:start + self.max_write]
+            offset = self.written % self.nbytes
+            first = min(len(block), self.nbytes - offset)
+            self._bytes[offset:offset + first] = block[:first]
+            self._bytes[:len(block) - first] = block[first:]
+            self.written += len(block)
+        self._notify()
+
+    def write_from(self, readinto, max_bytes):
+        """Lets readinto fill the buffer in place, without an intermediate bytes object.
+
+        Parameters
+        ----------
+        readinto : callable
+            Such as `serial.Serial.readinto`. Called with a writable memoryview over free space in the buffer, it returns the number of bytes it filled.
+
+        max_bytes : int
+            The most bytes to read in this call. Fewer are read at the end of the buffer, where it wraps around.
+
+        Returns
+        -------
+        The number of bytes read
+        """
+        offset = self.written % self.nbytes
+        size = min(max_bytes, self.max_write, self.nbytes - offset)
+        n = readinto(memoryview(self._bytes[offset:offset + size]))
+        if n:
+            self.written += n
+            self._notify()
+        return n
+
+    def close(self):
+        """Marks the end of the stream. Consumers waiting on the buffer are woken up.
+        """
+        self.closed = True
+        self._notify()
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def oldest(self, written=None):
+        """The index of the oldest item that is guaranteed not to be overwritten by a write in progress
+        """
+        written = self.items_written if written is None else written
+        return max(0, written - self.capacity + self._guard)
+
+    def get(self, start, stop, out=None):
+        """Copies items start to stop (absolute indices). The caller is responsible for checking that they have not been overwritten.
+
+        Parameters
+        ----------
+        out : numpy array, optional
+            A preallocated array of at least stop - start items to copy into. A new array is made if None.
+
+        Returns
+        -------
+        The copied items; a view into out if it was given
+        """
+        n = stop - start
+        if out is None:
+            out = np.empty(n, dtype=self.dtype)
+        i = start % self.capacity
+        first = min(n, self.capacity - i)
+        out[:first] = self._data[i:i + first]
+        out[first:n] = self._data[:n - first]
+        return out[:n]
+
+    def cursor(self, start=0):
+        """Makes a new consumer that starts reading at the absolute item index start
+        """
+        return RingCursor(self, start)
+
+    def wait(self, position, timeout=None):
+        """Blocks until more than position items have been written, or the buffer is closed
+
+        Returns
+        -------
+        True if there is something new to read
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.items_written > position or self.closed, timeout)
+
+
+class RingCursor():
+
+    def __init__(self, ring, start=0):
+        """A read position into a `RingBuffer`. Every consumer holds its own cursor.
+
+        Parameters
+        ----------
+        ring : RingBuffer
+
+        start : int, optional
+            The absolute index of the first item to read
+        """
+        self.ring = ring
+        self.position = start
+        # number of items this consumer missed because it fell behind
+        self.dropped = 0
+
+    @property
+    def available(self):
+        return self.ring.items_written - self.position
+
+    def read(self, max_items=None, out=None):
+        """Returns a copy of the items written since the last read, at most max_items of them.
+
+        Parameters
+        ----------
+        max_items : int, optional
+            The most items to return. Limited to len(out) if out is given.
+
+        out : numpy array, optional
+            A preallocated array of the ring's dtype to copy into, so that steady state reads allocate nothing
+
+        Returns
+        -------
+        A numpy array (a view into out if it was given). Its first item has the absolute index `position - len(array)` after the call.
+        """
+        if out is not None:
+            max_items = len(out) if max_items is None else min(max_items, len(out))
+        start = self.position
+        oldest = self.ring.oldest()
+        if start < oldest:
+            self.dropped += oldest - start
+            start = oldest
+        stop = self.ring.items_written
+        if max_items is not None:
+            stop = min(stop, start + max_items)
+        items = self.ring.get(start, stop, out)
+
+        # the producer may have lapped us while we were copying
+        oldest = self.ring.oldest()
+        if oldest > start:
+            lost = min(oldest, stop) - start
+            items = items[lost:]
+            self.dropped += lost
+        self.position = stop
+        return items
+
+    def wait(self, timeout=None):
+        """Blocks until there is something to read or the stream has ended
+        """
+        return self.ring.wait(self.position, timeout)
+
+    @property
+    def exhausted(self):
+        """True once the stream has ended and every item has been read"""
+        return self.ring.closed and self.available <= 0
+
+
+class Demultiplexer():
+
+    def __init__(self, channels, dtype=">u2"):
+        """Splits a stream of interleaved samples (ch0, ch1, ..., ch0, ch1, ...) by channel, whatever the size of the pieces it arrives in.
+
+        The byte phase (a sample split across two pieces) and the channel phase (a step split across two pieces) are carried from one piece to the next, so every piece yields whole steps only, split with a single reshape.
+
+        Parameters
+        ----------
+        channels : list
+            The channels interleaved in the stream, in order
+
+        dtype : numpy dtype, optional
+            The type of one sample. The default is a raw big endian ADC sample as sent by the FastDAC.
+        """
+        self.channels = list(channels)
+        self.dtype = np.dtype(dtype)
+        # absolute index of the next sample expected
+        self.position = 0
+        # number of samples thrown away to realign after a gap
+        self.skipped = 0
+        self._bytes = b""
+        self._samples = np.zeros(0, dtype=self.dtype)
+
+    @property
+    def pending(self):
+        """The number of samples held back until their step is complete"""
+        return len(self._samples)
+
+    def feed(self, data):
+        """Splits a piece of the raw byte stream.
+
+        Parameters
+        ----------
+        data : bytes-like
+            Any number of bytes
+
+        Returns
+        -------
+        A dictionary where the keys are the channels, and the values are numpy arrays of the samples of the steps completed by this piece. Every array has the same length.
+        """
+        if self._bytes:
+            data = self._bytes + bytes(data)
+        whole = len(data) - len(data) % self.dtype.itemsize
+        self._bytes = bytes(data[whole:])
+        return self.split(np.frombuffer(data, dtype=self.dtype, count=whole // self.dtype.itemsize))
+
+    def split(self, samples, start=None):
+        """Splits whole samples, e.g. as read from a `RingCursor`.
+
+        Parameters
+        ----------
+        samples : numpy array
+
+        start : int, optional
+            The absolute index of samples[0] in the stream. If samples were lost before it, the incomplete step held back is thrown away, and splitting resumes at the next step.
+
+        Returns
+        -------
+        As `feed`. The arrays are views into samples unless a step was completed across two pieces.
+        """
+        n = len(self.channels)
+        if start is not None and start != self.position:
+            self.skipped += len(self._samples)
+            self._samples = self._samples[:0]
+            self.position = start
+            # the first sample of the next whole step
+            lead = min(len(samples), -start % n)
+            self.skipped += lead
+            samples = samples[lead:]
+            self.position += lead
+        self.position += len(samples)
+
+        if len(self._samples):
+            samples = np.concatenate((self._samples, samples))
+        steps = len(samples) // n
+        self._samples = samples[steps*n:].copy()
+        frames = samples[:steps*n].reshape(steps, n)
+        return {ac: frames[:, k] for k, ac in enumerate(self.channels)}
+
+
+class AcquisitionStats():
+
+    def __init__(self, expected=None, sample_size=2):
+        """Counters that tell whether the host keeps up with a stream. They are plain numbers updated by the acquisition loops, at the cost of a few clock reads per block, and can be read from any thread while the stream runs.
+
+        A host that keeps up spends a small fraction of the stream decoding (`load`), sees a small `in_waiting_max` and drops nothing. A host that falls behind first shows a growing `in_waiting_max`, then dropped samples.
+
+        Parameters
+        ----------
+        expected : int or None, optional
+            The number of samples the instrument was asked for. None for streams without an end.
+
+        sample_size : int, optional
+            Bytes per sample, 2 for an ADC reading
+        """
+        self.expected = expected
+        self.sample_size = sample_size
+        # time.perf_counter() of the start of the first read and the end of the last one
+        self.started = None
+        self.stopped = None
+        self.bytes = 0
+        self.reads = 0
+        # the most bytes seen waiting in the OS buffer before a read
+        self.in_waiting_max = 0
+        # seconds spent in serial reads, i.e. waiting for the instrument
+        self.read_time = 0.0
+        # seconds the consumer waited for the reader thread
+        self.wait_time = 0.0
+        # seconds the consumer spent on the data: decoding, storing and plotting
+        self.decode_time = 0.0
+        # samples lost before they were decoded
+        self.dropped = 0
+
+    def read(self, nbytes, since, in_waiting=0):
+        """Records a serial read of nbytes that started at time.perf_counter() == since, with in_waiting bytes waiting before it
+        """
+        now = time.perf_counter()
+        if self.started is None:
+            self.started = since
+        self.stopped = now
+        self.read_time += now - since
+        self.bytes += nbytes
+        self.reads += 1
+        if in_waiting > self.in_waiting_max:
+            self.in_waiting_max = in_waiting
+
+    @property
+    def elapsed(self):
+        """Seconds from the start of the first read to the end of the latest one"""
+        if self.started is None:
+            return 0.0
+        return (self.stopped if self.stopped is not None else time.perf_counter()) - self.started
+
+    @property
+    def received(self):
+        """The number of samples received"""
+        return self.bytes // self.sample_size
+
+    @property
+    def missing(self):
+        """The number of expected samples not received, or None if the stream has no end"""
+        return None if self.expected is None else self.expected - self.received
+
+    @property
+    def byte_rate(self):
+        """Bytes per second received"""
+        return self.bytes/self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def sample_rate(self):
+        """Samples per second received"""
+        return self.byte_rate/self.sample_size
+
+    @property
+    def load(self):
+        """The fraction of the stream spent decoding. Close to 1, the host cannot keep up."""
+        return self.decode_time/self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        """Returns the counters and rates as a dictionary, e.g. to store them with the data
+        """
+        return {"expected": self.expected, "received": self.received, "missing": self.missing,
+                "dropped": self.dropped, "bytes": self.bytes, "reads": self.reads,
+                "elapsed_s": self.elapsed, "bytes_per_s": self.byte_rate, "samples_per_s": self.sample_rate,
+                "in_waiting_max": self.in_waiting_max, "read_time_s": self.read_time,
+                "wait_time_s": self.wait_time, "decode_time_s": self.decode_time, "load": self.load}
+
+    def __str__(self):
+        expected = "" if self.expected is None else " of {}".format(self.expected)
+        return ("{}{} samples in {:.3f} s ({:.0f} samples/s, {:.0f} bytes/s), {} dropped, "
+                "in_waiting <= {} bytes, decode {:.3f} s, wait {:.3f} s").format(
+            self.received, expected, self.elapsed, self.sample_rate, self.byte_rate, self.dropped,
+            self.in_waiting_max, self.decode_time, self.wait_time)
+
+
+def discard_cancel(ser):
+    """Throws away a `cancel_read` that was sent after the read it meant to stop had returned.
+
+    pyserial on POSIX cancels a read by writing to a pipe that the next read checks first, so a late cancel would cut the next read, e.g. the reply to the next command, short. Does nothing on the ports that do not cancel through a pipe.
+
+    Parameters
+    ----------
+    ser : serial.Serial
+    """
+    pipe = getattr(ser, "pipe_abort_read_r", None)
+    if pipe is None:
+        return
+    while select.select([pipe], [], [], 0)[0]:
+        os.read(pipe, 1000)
+
+
+class SerialReader(threading.Thread):
+
+    def __init__(self, ser, ring, nbytes=None, name="SerialReader", byte_rate=None, latency=0.02, stats=None):
+        """A thread that drains a serial port into a `RingBuffer`.
+
+        Every read asks for about latency seconds of data at the byte rate of the stream, so the number of reads per second, and the CPU they cost, does not depend on the rate, and no data waits longer than latency to reach the ring buffer. A backlog in the OS buffer is read at once.
+
+        Parameters
+        ----------
+        ser : serial.Serial
+            An open serial port
+
+        ring : RingBuffer
+
+        nbytes : int or None, optional
+            The number of bytes to read before stopping. Reads until `stop` is called if None.
+
+        byte_rate : float or None, optional
+            The expected bytes per second, e.g. 2/conversion time for SPEC_ANA. Measured from the stream if None; the estimate is refined from the measured rate either way.
+
+        latency : float, optional
+            The target seconds of data per read
+
+        stats : AcquisitionStats, optional
+            Where the reads are counted. A new one is made if None.
+        """
+        super().__init__(name=name, daemon=True)
+        self.ser = ser
+        self.ring = ring
+        self.nbytes = nbytes
+        self.byte_rate = byte_rate
+        self.latency = latency
+        self.received = 0
+        self.error = None
+        itemsize = ring.dtype.itemsize
+        self.stats = stats if stats is not None else AcquisitionStats(
+            None if nbytes is None else nbytes // itemsize, itemsize)
+        self._in_waiting = 0
+        self._stop_event = threading.Event()
+        # whether a read is in progress, and whether stop cancelled it
+        self._read_lock = threading.Lock()
+        self._reading = False
+        self._cancelled = False
+
+    def next_read_size(self):
+        """The number of bytes to ask the serial port for next
+        """
+        itemsize = self.ring.dtype.itemsize
+        size = self._in_waiting = self.ser.in_waiting
+        if self.byte_rate is not None:
+            size = max(size, int(self.byte_rate*self.latency))
+        size = max(itemsize, size // itemsize*itemsize)
+        size = min(size, self.ring.max_write)
+        if self.nbytes is not None:
+            size = min(size, self.nbytes - self.received)
+        return size
+
+    def _measure(self, now):
+        """Refines byte_rate from the bytes received since the last measurement, once it is at least ten reads old (one read if there is no estimate yet)
+        """
+        since, received = self._mark
+        if now - since < (10 if self.byte_rate is not None else 1)*self.latency:
+            return
+        rate = (self.received - received)/(now - since)
+        self.byte_rate = rate if self.byte_rate is None else 0.5*self.byte_rate + 0.5*rate
+        self._mark = (now, self.received)
+
+    def run(self):
+        try:
+            self._mark = None
+            while not self._stop_event.is_set():
+                if self.nbytes is not None and self.received >= self.nbytes:
+                    break
+                size = self.next_read_size()
+                since = time.perf_counter()
+                with self._read_lock:
+                    if self._stop_event.is_set():
+                        break
+                    self._reading = True
+                try:
+                    # read straight into the ring buffer's memory
+                    n = self.ring.write_from(self.ser.readinto, size)
+                finally:
+                    self._end_read()
+                if not n:
+                    if self._stop_event.is_set():
+                        break
+                    raise serial.SerialException(
+                        "Timed out after reading {} bytes".format(self.received))
+                self.received += n
+                self.stats.read(n, since, self._in_waiting)
+                now = self.stats.stopped
+                # measure from the end of the first read, which includes the
+                # instrument's reply time
+                if self._mark is None:
+                    self._mark = (now, self.received)
+                else:
+                    self._measure(now)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ring.close()
+
+    def _end_read(self):
+        with self._read_lock:
+            self._reading = False
+            if self._cancelled:
+                # the read may have returned before the cancel reached it
+                discard_cancel(self.ser)
+                self._cancelled = False
+
+    def stop(self):
+        """Asks the thread to stop after the read in progress, and cancels that read if it is waiting for data
+        """
+        with self._read_lock:
+            self._stop_event.set()
+            if not self._reading:
+                # nothing to cancel: a cancel now would cut the next read of the port short
+                return
+            cancel_read = getattr(self.ser, "cancel_read", None)
+            if cancel_read is not None:
+                try:
+                    cancel_read()
+                    self._cancelled = True
+                except Exception:
+                    pass
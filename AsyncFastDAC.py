@@ -0,0 +1,276 @@
+"""
+This module provides an asyncio client for the FastDACs that live in the Quantum Devices Group at UBC, Vancouver.
+
+`AsyncFastDAC` registers the serial port's file descriptor with the event loop, so one event loop can drive several instruments and a UI without threads. Commands can be awaited, and cancelled like any other coroutine.
+
+Example
+-------
+async with AsyncFastDAC("/dev/ttyACM0", 1750000, timeout=1) as fd:
+    await fd.RAMP_SMART(0, 100, 1000)
+    async for chunk in fd.SPEC_ANA([0, 1], 10000):
+        ...
+"""
+import asyncio
+import serial
+from FastDAC import FastDAC
+from Acquisition import Demultiplexer
+
+
+class AsyncFastDAC():
+
+    def __init__(self, port: str, baudrate: int, timeout: float, verbose=False, poll_interval=0.001):
+        """ Makes a new AsyncFastDAC object. The serial port is opened by `open`, or by entering an ``async with" block.
+
+        Parameters
+        ----------
+        port : str
+            Example "COM5", "dev/ttyacm0"
+
+        baudrate : int
+            Common values are 1750000
+
+        timeout : float
+            How long to wait for the next bytes from the instrument before giving up
+
+        poll_interval : float, optional
+            Only used where the event loop cannot watch the serial port (e.g. COM ports on Windows): how often to poll the port in seconds
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.verbose = verbose
+        self.poll_interval = poll_interval
+        self.ser = None
+
+        self._buffer = bytearray()
+        self._data_ready = asyncio.Event()
+        # one command (and its reply) at a time
+        self._lock = asyncio.Lock()
+        self._fd = None
+        self._poller = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Opens the serial port, attaches it to the running event loop, and confirms the identity of the instrument
+
+        Returns
+        -------
+        The IDN string
+        """
+        # non blocking: the event loop tells us when there is something to read
+        self.ser = serial.Serial(self.port, self.baudrate, timeout=0)
+        self.ser.reset_input_buffer()
+        self.ser.reset_output_buffer()
+
+        loop = asyncio.get_running_loop()
+        try:
+            self._fd = self.ser.fileno()
+            loop.add_reader(self._fd, self._on_readable)
+        except (AttributeError, NotImplementedError):
+            self._fd = None
+            self._poller = loop.create_task(self._poll())
+
+        id = await self.IDN()
+        assert id, "Empty IDN Received."
+        return id
+
+    async def close(self):
+        """Detaches the serial port from the event loop and closes it
+        """
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._fd = None
+        if self._poller is not None:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+        if self.ser is not None:
+            self.ser.close()
+
+    def _on_readable(self):
+        data = self.ser.read(max(1, self.ser.in_waiting))
+        if data:
+            self._buffer += data
+            self._data_ready.set()
+
+    async def _poll(self):
+        while True:
+            waiting = self.ser.in_waiting
+            if waiting:
+                self._buffer += self.ser.read(waiting)
+                self._data_ready.set()
+            else:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _wait_until(self, predicate):
+        """Waits until predicate() is true. Times out if no new bytes arrive within self.timeout.
+        """
+        while not predicate():
+            self._data_ready.clear()
+            # not asyncio.wait_for, which can swallow a cancellation that
+            # arrives together with new data
+            waiter = asyncio.ensure_future(self._data_ready.wait())
+            try:
+                done, pending = await asyncio.wait({waiter}, timeout=self.timeout)
+            finally:
+                waiter.cancel()
+            if not done:
+                raise serial.SerialException(
+                    "Timed out with {} bytes buffered".format(len(self._buffer)))
+
+    def _pop(self, n):
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readline(self):
+        """Reads one CR/LF terminated reply
+
+        Returns
+        -------
+        A str without the line ending
+        """
+        await self._wait_until(lambda: b"\n" in self._buffer)
+        data = self._pop(self._buffer.index(b"\n") + 1)
+        if self.verbose:
+            print(data)
+        return data.decode('ascii').rstrip('\r\n')
+
+    async def read_exactly(self, nbytes):
+        """Reads exactly nbytes of binary data
+        """
+        await self._wait_until(lambda: len(self._buffer) >= nbytes)
+        return self._pop(nbytes)
+
+    async def read_some(self, max_bytes):
+        """Reads whatever has arrived, at most max_bytes, waiting for at least one byte
+        """
+        await self._wait_until(lambda: len(self._buffer) > 0)
+        return self._pop(min(max_bytes, len(self._buffer)))
+
+    def write(self, command):
+        """Write a command to the instrument.
+
+        Parameters
+        ----------
+        command : byte str
+            a ''wellformed" byte string with carriage return at the end
+        """
+        if self.verbose:
+            print("CMD: {}".format(command))
+        self.ser.write(command)
+
+    async def query(self, command):
+        """Queries a command from the instrument
+
+        Parameters
+        ----------
+        command : byte str
+            a ''wellformed" byte string with carriage return at the end
+
+        Returns
+        -------
+        A string
+        """
+        async with self._lock:
+            self.write(command)
+            return await self.readline()
+
+    def STOP(self):
+        """Stops any sweeps or reads that the FastDAC is currently doing
+        """
+        self.write(b"STOP\r")
+
+    async def _abort(self):
+        """Stops a stream that was cut short, and throws away the rest of it, so the next command gets its own reply
+        """
+        self.STOP()
+        # give the instrument time to stop, then discard the rest of the stream
+        await asyncio.sleep(0.1)
+        self._buffer.clear()
+
+    async def IDN(self):
+        """Confirms the identity of the instrument
+        """
+        return await self.query(b"*IDN?\r")
+
+    async def RAMP_SMART(self, channel=0, setPoint=0, rampRate=1000):
+        """Changes the output of a DAC channel to the setPoint from its initial value at the rampRate [mV/s]. See `FastDAC.RAMP_SMART`.
+        """
+        cmd = "RAMP_SMART,{},{},{}\r".format(channel, setPoint, rampRate)
+        return await self.query(bytes(cmd, "ascii"))
+
+    async def RAMP_AND_READ(self, DAC_channels=[0, ], ADC_channels=[0, ],  steps=1000, rampRanges={0: [-100, 100], }):
+        """Ramps the specified DAC channels, and read on the specified ADC channels at the same time. See `FastDAC.RAMP_AND_READ`.
+
+        Returns
+        -------
+        A dictionary where the keys represents the adc channels that was read, and the value is a numpy array of readings.
+        """
+        cmd = FastDAC.INT_RAMP_command(
+            DAC_channels, ADC_channels, steps, rampRanges)
+
+        async with self._lock:
+            self.write(cmd)
+            buffer = None
+            try:
+                buffer = await self.read_exactly(steps*len(ADC_channels)*2)
+            finally:
+                # cancelled, or timed out
+                if buffer is None:
+                    await self._abort()
+            data = await self.readline()
+        print(data)
+
+        readings = FastDAC.decode_interleaved(buffer, len(ADC_channels))
+        return {ac: readings[k] for k, ac in enumerate(ADC_channels)}
+
+    async def SPEC_ANA(self, channels=[0, ], steps=10, chunk_size=4096):
+        """Reads steps points from each ADC channel, yielding the readings as they arrive.
+
+        Closing the generator early (``aclose()"), or cancelling the task, stops the FastDAC.
+
+        Parameters
+        ----------
+        channels : list, optional
+            The ADC channels to read
+
+        steps : int, optional
+            The number of data points to read per channel
+
+        chunk_size : int, optional
+            The maximum number of bytes decoded per chunk
+
+        Yields
+        ------
+        A dictionary where the keys are the adc channels, and the values are numpy arrays of the new readings in mV
+        """
+        remaining = steps*len(channels)*2
+        # samples and steps may be split across two chunks
+        demux = Demultiplexer(channels)
+
+        async with self._lock:
+            self.write(FastDAC.SPEC_ANA_command(channels, steps))
+            try:
+                while remaining > 0:
+                    data = await self.read_some(min(chunk_size, remaining))
+                    remaining -= len(data)
+
+                    raw = demux.feed(data)
+                    if len(raw[channels[0]]):
+                        yield {ac: FastDAC.map_int16_to_mV(samples) for ac, samples in raw.items()}
+            finally:
+                if remaining > 0:
+                    await self._abort()
+            data = await self.readline()
+        if self.verbose:
+            print(data)
@@ -0,0 +1,262 @@
+"""
+This module benchmarks how many samples per second the acquisition methods of `FastDAC` and `PIDFastDAC` can decode before the host CPU becomes the limit.
+
+Every method is fed a synthetic (or recorded) byte stream, either from memory through `ReplaySerial` or through a `FastDACEmulator` pseudo-terminal running flat out. For every combination of method, channel count, sample count and chunk size, one JSON object is printed per line with the samples per second, the CPU time per sample and the peak memory, so results can be stored and compared to track regressions.
+
+Example
+-------
+python Benchmark.py --methods SPEC_ANA RAMP_AND_READ --channels 1 8 --samples 100000 --chunk-sizes 64 4096 > bench_output.txt
+"""
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from contextlib import redirect_stdout
+from FastDAC import FastDAC
+from PIDFastDAC import PIDFastDAC
+
+METHODS = ["SPEC_ANA", "read_vs_time", "RAMP_AND_READ", "START_PID"]
+
+
+class ReplaySerial():
+
+    def __init__(self, stream, chunk_size=4096):
+        """Stands in for a `serial.Serial` object, serving a prerecorded byte stream.
+
+        Parameters
+        ----------
+        stream : bytes
+            Everything the instrument would send, replies included
+
+        chunk_size : int, optional
+            The most bytes that arrive at once, i.e. how the stream arrives: `in_waiting` and every read return at most this many
+        """
+        self._stream = io.BytesIO(stream)
+        self._size = len(stream)
+        self.chunk_size = chunk_size
+        self.is_open = True
+        self.timeout = 1
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk_size, self._size - self._stream.tell())
+
+    def read(self, size=1):
+        return self._stream.read(min(size, self.chunk_size))
+
+    def readinto(self, b):
+        return self._stream.readinto(memoryview(b).cast("B")[:self.chunk_size])
+
+    def readline(self):
+        return self._stream.readline()
+
+    def write(self, data):
+        return len(data)
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def cancel_read(self):
+        pass
+
+
+def make_samples(n, recording=None, seed=0):
+    """Returns n big endian ADC samples as bytes, either random or repeated from a recording
+
+    Parameters
+    ----------
+    n : int
+        The number of samples
+
+    recording : str, optional
+        Path to a file of raw big endian samples, as sent by the FastDAC
+    """
+    if recording is None:
+        rng = np.random.default_rng(seed)
+        return rng.integers(0, 65536, n, dtype=np.uint16).astype(">u2").tobytes()
+    raw = np.fromfile(recording, dtype=">u2")
+    assert len(raw) > 0, "Empty recording"
+    return np.resize(raw, n).tobytes()
+
+
+def make_pid_frames(n, seed=0):
+    """Returns n PID telemetry frames as bytes: little endian PV and CO floats, then the 0xA5, 0x5A sync bytes
+    """
+    rng = np.random.default_rng(seed)
+    frames = np.zeros(n, dtype=[("pv", "<f4"), ("co", "<f4"), ("sync", "u1", 2)])
+    frames["pv"] = rng.normal(0, 100, n)
+    frames["co"] = rng.normal(0, 100, n)
+    frames["sync"] = (0xA5, 0x5A)
+    return frames.tobytes()
+
+
+def prepare(method, channels, samples, recording=None):
+    """Builds the byte stream a method expects, and a function that runs the method on a given instrument object
+
+    Returns
+    -------
+    (stream, run, n_samples) where run(fd) runs the method and n_samples is the total number of decoded values
+    """
+    adcs = list(range(channels))
+    if method == "SPEC_ANA":
+        stream = make_samples(samples*channels, recording) + b"READ_FINISHED\r\n"
+        return stream, lambda fd: fd.SPEC_ANA(adcs, samples), samples*channels
+    if method == "read_vs_time":
+        # read_vs_time derives the number of steps from the duration and the
+        # conversion time, which is put in the instrument state so that it is
+        # not queried
+        convert_time = 100
+        duration = samples*channels*convert_time*1e-6
+        stream = make_samples(samples*channels, recording) + b"READ_FINISHED\r\n"
+
+        def run(fd):
+            fd.state.convert_times.update({c: convert_time for c in adcs})
+            return fd.read_vs_time(None, duration, adcs)
+        return stream, run, samples*channels
+    if method == "RAMP_AND_READ":
+        stream = make_samples(samples*channels, recording) + b"RAMP_FINISHED\r\n"
+        return stream, lambda fd: fd.RAMP_AND_READ([0], adcs, samples, {0: [-1000, 1000]}), samples*channels
+    if method == "START_PID":
+        return make_pid_frames(samples), lambda fd: fd.START_PID(samples), samples*2
+    raise ValueError("Unknown method {}".format(method))
+
+
+def measure(method, channels, samples, chunk_size, recording=None, transport="replay"):
+    """Runs one benchmark case
+
+    Returns
+    -------
+    A dictionary of the results
+    """
+    stream, run, n_samples = prepare(method, channels, samples, recording)
+    fd = PIDFastDAC("replay", 1750000, 1, testing=True) if method == "START_PID" else FastDAC(
+        "replay", 1750000, 1, testing=True)
+
+    def timed():
+        fd.ser = ReplaySerial(stream, chunk_size)
+        wall, cpu = time.perf_counter(), time.process_time()
+        # keep the instrument's closing messages out of the JSON output
+        with redirect_stdout(io.StringIO()):
+            run(fd)
+        return time.perf_counter() - wall, time.process_time() - cpu
+
+    wall, cpu = timed()
+    # a separate run, as tracing allocations slows everything down
+    tracemalloc.start()
+    timed()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"method": method,
+            "channels": channels if method != "START_PID" else 2,
+            "samples": n_samples,
+            "chunk_size": chunk_size,
+            "transport": transport,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "samples_per_s": n_samples/wall,
+            "cpu_ns_per_sample": 1e9*cpu/n_samples,
+            "peak_memory_bytes": peak,
+            "bytes_per_sample": peak/n_samples,
+            }
+
+
+def measure_emulated(method, channels, samples, chunk_size=None, recording=None):
+    """Runs one benchmark case end to end through a `FastDACEmulator` pseudo-terminal, producing data as fast as the client reads it. chunk_size and recording are ignored.
+    """
+    from FastDACEmulator import FastDACEmulator
+    adcs = list(range(channels))
+    with FastDACEmulator(realtime=False) as emu, redirect_stdout(io.StringIO()):
+        if method == "START_PID":
+            fd = PIDFastDAC(emu.port, 1750000, 1)
+            n_samples = samples*2
+
+            def run():
+                fd.START_PID(samples, stopPID=True)
+        else:
+            fd = FastDAC(emu.port, 1750000, 1)
+            n_samples = samples*channels
+            for c in adcs:
+                fd.SET_CONVERT_TIME(c, 82)
+            run = {"SPEC_ANA": lambda: fd.SPEC_ANA(adcs, samples),
+                   "read_vs_time": lambda: fd.read_vs_time(None, samples*channels*82e-6, adcs),
+                   "RAMP_AND_READ": lambda: fd.RAMP_AND_READ([0], adcs, samples, {0: [-1000, 1000]})}[method]
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        run()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        fd.ser.close()
+
+    # the emulator runs in this process, so cpu_s includes producing the data
+    return {"method": method,
+            "channels": channels if method != "START_PID" else 2,
+            "samples": n_samples,
+            "chunk_size": None,
+            "transport": "pty",
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "samples_per_s": n_samples/wall,
+            "cpu_ns_per_sample": 1e9*cpu/n_samples,
+            "peak_memory_bytes": None,
+            "bytes_per_sample": None,
+            }
+
+
+def run_suite(methods=METHODS, channels=[1, 8], samples=[100000], chunk_sizes=[4096], repeat=1, recording=None, transport="replay", out=sys.stdout):
+    """Runs every combination of the parameters and writes one JSON object per line to out
+
+    Returns
+    -------
+    A list of the result dictionaries
+    """
+    results = list()
+    environment = {"python": platform.python_version(), "numpy": np.__version__,
+                   "machine": platform.machine(), "timestamp": time.time()}
+    for method in methods:
+        for n_channels in (channels if method != "START_PID" else [2]):
+            for n in samples:
+                for chunk_size in (chunk_sizes if transport == "replay" else [None]):
+                    for r in range(repeat):
+                        if transport == "replay":
+                            result = measure(method, n_channels, n, chunk_size, recording)
+                        else:
+                            result = measure_emulated(method, n_channels, n)
+                        result["repeat"] = r
+                        result.update(environment)
+                        out.write(json.dumps(result) + "\n")
+                        out.flush()
+                        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--methods", nargs="+", default=METHODS, choices=METHODS)
+    parser.add_argument("--channels", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--samples", nargs="+", type=int, default=[100000],
+                        help="samples per channel (frames for START_PID)")
+    parser.add_argument("--chunk-sizes", nargs="+", type=int, default=[4096],
+                        help="bytes waiting in the OS buffer per read")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--recording", default=None,
+                        help="file of raw big endian samples to replay instead of random data")
+    parser.add_argument("--transport", choices=["replay", "pty"], default="replay",
+                        help="replay from memory, or go through a FastDACEmulator pseudo-terminal")
+    parser.add_argument("--output", default=None,
+                        help="file to append the JSON lines to, stdout if not given")
+    args = parser.parse_args()
+
+    out = open(args.output, "a") if args.output else sys.stdout
+    try:
+        run_suite(args.methods, args.channels, args.samples, args.chunk_sizes,
+                  args.repeat, args.recording, args.transport, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
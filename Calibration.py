@@ -0,0 +1,140 @@
+"""
+This module calibrates the ADC channels of a FastDAC.
+
+Every ADC channel has its own offset and gain error, which depend on the conversion time: "for the AD7734, conversion times faster than approximately 300us will start to exhibit a linear calibration offset >1mV at full range". A `Calibration` holds a gain and offset for every (channel, conversion time) pair, such that
+
+    calibrated mV = gain*`FastDAC.map_int16_to_mV`(counts) + offset
+
+and `measure` finds them by reading back known DAC outputs. Set `FastDAC.calibration` to apply a calibration to every reading. The calibrated map is precomputed for all 65536 possible counts (`lookup_table`), so decoding is a single table lookup and costs no more than the uncalibrated map.
+
+Example
+-------
+cal = Calibration.measure(fd, ADC_channel=0, DAC_channel=0, convert_times=[82, 300, 1000])
+cal.save("Measurement_Data/calibration.json")
+fd.calibration = Calibration.load("Measurement_Data/calibration.json")
+"""
+import json
+import functools
+import numpy as np
+from pathlib import Path
+
+
+@functools.lru_cache(maxsize=64)
+def lookup_table(gain=1.0, offset=0.0, dtype=np.float64):
+    """Returns the calibrated mV of every 16 bit count, as a read only numpy array of 65536 floats. Tables are cached.
+
+    The table is computed in double precision and then cast to dtype, so a np.float32 table gives the same values as converting to float64 and casting.
+    """
+    # imported here, as FastDAC imports this module
+    from FastDAC import FastDAC
+    table = FastDAC.map_int16_to_mV(np.arange(65536, dtype=np.float64))
+    if gain != 1.0 or offset != 0.0:
+        table = gain*table + offset
+    table = table.astype(dtype, copy=False)
+    table.flags.writeable = False
+    return table
+
+
+class Calibration():
+
+    def __init__(self, entries=None):
+        """Makes a new calibration.
+
+        Parameters
+        ----------
+        entries : dict, optional
+            The keys are (ADC channel, conversion time in uS) tuples, and the values are (gain, offset in mV) tuples
+        """
+        self.entries = dict()
+        for (channel, convert_time), (gain, offset) in (entries or dict()).items():
+            self.set(channel, convert_time, gain, offset)
+
+    def set(self, channel, convert_time, gain, offset):
+        """Stores the gain and offset of a channel at a conversion time
+        """
+        self.entries[(int(channel), int(convert_time))] = (float(gain), float(offset))
+
+    def get(self, channel, convert_time):
+        """Returns the (gain, offset) of a channel at a conversion time. A pair that was never calibrated is left as it is, (1.0, 0.0).
+        """
+        if convert_time is None:
+            return (1.0, 0.0)
+        return self.entries.get((int(channel), int(convert_time)), (1.0, 0.0))
+
+    def table(self, channel, convert_time):
+        """Returns the `lookup_table` of a channel at a conversion time
+        """
+        return lookup_table(*self.get(channel, convert_time))
+
+    def save(self, path):
+        """Writes the calibration to a JSON file
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        entries = [{"channel": c, "convert_time_us": t, "gain": g, "offset_mV": o}
+                   for (c, t), (g, o) in sorted(self.entries.items())]
+        with open(path, "w") as f:
+            json.dump({"entries": entries}, f, indent=2)
+
+    @staticmethod
+    def load(path):
+        """Reads a calibration written by `save`
+        """
+        with open(path) as f:
+            entries = json.load(f)["entries"]
+        return Calibration({(e["channel"], e["convert_time_us"]): (e["gain"], e["offset_mV"]) for e in entries})
+
+    @staticmethod
+    def measure(fastdac, ADC_channel, DAC_channel, convert_times=[82, 300, 1000, 2686], setpoints=[-5000, 0, 5000], samples=1000, rampRate=10000, calibration=None):
+        """Measures the gain and offset of an ADC channel by reading back a DAC channel wired to it, at every conversion time.
+
+        The DAC outputs are taken as the reference. A straight line through the mean reading at every setpoint gives the gain and offset. The conversion time and DAC output are restored afterwards.
+
+        Parameters
+        ----------
+        fastdac : FastDAC
+
+        ADC_channel : int
+
+        DAC_channel : int
+            A DAC channel connected to the ADC channel
+
+        convert_times : list, optional
+            The conversion times in uS to calibrate. The instrument may round them; the calibration is stored under the time it reports.
+
+        setpoints : list, optional
+            The DAC outputs in mV to read back
+
+        samples : int, optional
+            The number of readings averaged at every setpoint
+
+        rampRate : float, optional
+            The DAC ramp rate in mV/s between setpoints
+
+        calibration : Calibration, optional
+            A calibration to add the results to. A new one is made if None.
+
+        Returns
+        -------
+        The `Calibration`
+        """
+        assert len(setpoints) >= 2, "At least two setpoints are needed to find a gain"
+        from FastDAC import FastDAC
+        calibration = Calibration() if calibration is None else calibration
+        initial_time = fastdac.convert_time(ADC_channel)
+        initial_output = fastdac.DAC_output(DAC_channel)
+        try:
+            for convert_time in convert_times:
+                fastdac.SET_CONVERT_TIME(ADC_channel, convert_time)
+                actual = fastdac.convert_time(ADC_channel)
+                measured = list()
+                for setpoint in setpoints:
+                    fastdac.RAMP_SMART(DAC_channel, setpoint, rampRate)
+                    # the raw counts, whatever calibration fastdac applies
+                    trace = fastdac.SPEC_ANA([ADC_channel], samples, traces=True)[ADC_channel]
+                    measured.append(FastDAC.map_int16_to_mV(trace.raw().mean()))
+                gain, offset = np.polyfit(measured, setpoints, 1)
+                calibration.set(ADC_channel, actual, gain, offset)
+        finally:
+            fastdac.SET_CONVERT_TIME(ADC_channel, initial_time)
+            fastdac.RAMP_SMART(DAC_channel, initial_output, rampRate)
+        return calibration
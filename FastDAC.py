@@ -2,18 +2,47 @@
 This module provides a `pyserial` interface to instruments called FastDACs that live in the Quantum Devices Group at UBC, Vancouver. The original author is Ruiheng Su. 
 """
 import time
+import inspect
 import serial
 import struct
 from re import I
 import numpy as np
 from pathlib import Path
 import logging
-from scipy import signal
+from collections import deque
+from contextlib import contextmanager
+from Acquisition import RingBuffer, SerialReader, Demultiplexer, AcquisitionStats
+from ADCTrace import ADCTrace
+from LivePlot import LivePlot
+from Spectrum import StreamingWelch
+from Calibration import lookup_table
 
 logging.basicConfig(level=logging.DEBUG,
                     format='(%(threadName)-9s) %(message)s',)
 
 
+class InstrumentState():
+
+    def __init__(self):
+        """What the client last knew about the instrument, so that setup queries can be skipped. None, or a missing channel, means unknown.
+
+        The state is kept up to date by the commands sent through the `FastDAC` object that owns it. Changes made any other way (the front panel, another program) are not seen; call `FastDAC.refresh` to read everything back.
+        """
+        self.idn = None
+        # ADC channel: conversion time in uS
+        self.convert_times = dict()
+        # DAC channel: output in mV
+        self.DAC = dict()
+
+    def invalidate(self, convert_times=True, DAC=True):
+        """Forgets the conversion times and/or the DAC outputs
+        """
+        if convert_times:
+            self.convert_times.clear()
+        if DAC:
+            self.DAC.clear()
+
+
 class FastDAC():
 
     def __init__(self, port: str, baudrate: int, timeout: int, testing=False, verbose=False, datapath="Measurement_Data"):
@@ -38,6 +67,14 @@ class FastDAC():
         A str 
         """
         self.verbose = verbose
+        # (command, seconds) of the most recent commands
+        self.latencies = deque(maxlen=1000)
+        self.__session = False
+        self.state = InstrumentState()
+        # a Calibration applied to every reading, or None
+        self.calibration = None
+        # the AcquisitionStats of the running or most recent stream
+        self.stats = None
         # private class variables
         self.__baudrate = baudrate
         self.__timeout = timeout
@@ -108,9 +145,49 @@ class FastDAC():
         self.ser.port = self.__port
         print("Port MODIFIED")
 
+    @property
+    def in_session(self):
+        return self.__session
+
+    @contextmanager
+    def session(self):
+        """Keeps the serial port open for every command issued inside the with block, and closes it once at the end.
+
+        Without a session, `query` and `write` open and close the serial port for every command. Sessions can be nested; only the outermost one closes the port.
+
+        Example
+        -------
+        with fd.session():
+            for c in range(4):
+                fd.GET_DAC(c)
+        """
+        nested = self.__session
+        self._open()
+        self.__session = True
+        try:
+            yield self
+        finally:
+            if not nested:
+                self.__session = False
+                self.ser.close()
+
+    def _open(self):
+        """Opens the serial port if it is not open already
+        """
+        if not self.ser.is_open:
+            self.ser.open()
+
+    def _close(self):
+        """Closes the serial port, unless a session is keeping it open
+        """
+        if not self.__session:
+            self.ser.close()
+
     def query(self, command):
         """Queries a command from the instrument 
 
+        The round trip time of the command, including opening and closing the port, is appended to `latencies`.
+
         Parameters
         ----------
         command : byte str 
@@ -123,9 +200,8 @@ class FastDAC():
         if self.verbose:
             print("CMD: {}".format(command))
 
-        if not self.ser.is_open:
-            self.ser.open()
-
+        start = time.perf_counter()
+        self._open()
         self.ser.write(command)
 
         try:
@@ -134,11 +210,53 @@ class FastDAC():
                 print(data)
             data = data.decode('ascii').rstrip('\r\n')
         except:
-            self.ser.close()
+            self._close()
             raise
-        self.ser.close()
+        self._close()
+        self.latencies.append((command, time.perf_counter() - start))
         return data
 
+    def query_batch(self, commands, window=None):
+        """Queries several commands from the instrument, pipelined.
+
+        The commands are written back to back without waiting for a reply in between, and the CR/LF terminated replies are then read in order. This costs roughly one round trip per batch instead of one per command.
+
+        Parameters
+        ----------
+        commands : list of byte str 
+            ''wellformed" byte strings with carriage return at the end  
+
+        window : int, optional
+            The maximum number of commands in flight at once. All commands are sent at once if None.
+
+        Returns
+        -------
+        A list of strings, the i-th being the reply to commands[i]
+        """
+        if self.verbose:
+            print("CMD: {}".format(commands))
+        window = len(commands) if window is None else window
+        assert window > 0, "The window must hold at least one command"
+
+        start = time.perf_counter()
+        self._open()
+        replies = list()
+        try:
+            for i in range(0, len(commands), window):
+                sent = commands[i:i + window]
+                self.ser.write(b"".join(sent))
+                for _ in sent:
+                    data = self.ser.readline()
+                    if self.verbose:
+                        print(data)
+                    replies.append(data.decode('ascii').rstrip('\r\n'))
+        except:
+            self._close()
+            raise
+        self._close()
+        self.latencies.append((b"".join(commands), time.perf_counter() - start))
+        return replies
+
     def write(self, command, close=True):
         """Write a command to the instrument. 
 
@@ -148,15 +266,58 @@ class FastDAC():
             a ''wellformed" byte string with carriage return at the end  
 
         close : bool, optional
-            closes the serial port if True. Otherwise, leave the serial port open.
+            closes the serial port if True. Otherwise, leave the serial port open. Has no effect inside a session.
         """
         if self.verbose:
             print("CMD: {}".format(command))
-        if not self.ser.is_open:
-            self.ser.open()
+        start = time.perf_counter()
+        self._open()
         self.ser.write(command)
         if close:
-            self.ser.close()
+            self._close()
+        self.latencies.append((command, time.perf_counter() - start))
+
+    def read_block(self, nbytes, block_size=4096, out=None, stats=None):
+        """Reads exactly nbytes from the serial port into a preallocated buffer.
+
+        The bytes are read in blocks of at most block_size, so that the serial timeout applies to every block rather than to the whole read. 
+
+        Parameters
+        ----------
+        nbytes : int 
+            The number of bytes to read 
+
+        block_size : int, optional
+            The maximum number of bytes to request from the serial port at once
+
+        out : writable bytes-like, optional
+            A buffer of at least nbytes to read into, so that repeated reads can reuse it. A new bytearray is made if None.
+
+        stats : AcquisitionStats, optional
+            Where the reads are counted
+
+        Raises
+        ------
+        serial.SerialException if the port times out before nbytes have been read
+
+        Returns
+        -------
+        A memoryview of the nbytes read 
+        """
+        buffer = memoryview(bytearray(nbytes) if out is None else out).cast("B")[:nbytes]
+        received = 0
+        while received < nbytes:
+            if stats is not None:
+                in_waiting = self.ser.in_waiting
+                since = time.perf_counter()
+            n = self.ser.readinto(buffer[received:min(nbytes, received + block_size)])
+            if not n:
+                raise serial.SerialException(
+                    "Timed out after reading {} of {} bytes".format(received, nbytes))
+            received += n
+            if stats is not None:
+                stats.read(n, since, in_waiting)
+        return buffer
 
     @staticmethod
     def two_bytes_to_int(two_bytes, bigEndian=True):
@@ -233,6 +394,100 @@ class FastDAC():
         """
         return (int_val - 0) * (20000.0) / (65536.0) - 10000.0
 
+    @staticmethod
+    def map_int16_to_mV_into(int_val, out):
+        """Same as `map_int16_to_mV`, but writes the result into the preallocated float array out instead of allocating a new one.
+
+        Returns
+        -------
+        out 
+        """
+        np.multiply(int_val, 20000.0, out=out)
+        np.divide(out, 65536.0, out=out)
+        np.subtract(out, 10000.0, out=out)
+        return out
+
+    @staticmethod
+    def map_int16_to_mV_calibrated(int_val, gain=1.0, offset=0.0, out=None):
+        """Same as `map_int16_to_mV`, followed by gain*mV + offset. The map is looked up in a precomputed table of all 65536 counts with `np.take`, which is faster than computing even the plain map. Pass out to also skip allocating the result.
+
+        Parameters
+        ----------
+        int_val : numpy array 
+            Raw 16 bit counts, of any byte order 
+
+        gain : float, optional 
+
+        offset : float, optional 
+            In mV 
+
+        out : numpy array, optional 
+            A preallocated float array to write the result into 
+
+        Returns
+        -------
+        A numpy array of readings in mV; out if it was given 
+        """
+        # counts are always within the table; "clip" skips the bounds check,
+        # and writes into out without a temporary. Indexing the table with
+        # int_val instead is more than twice as slow.
+        return np.take(lookup_table(gain, offset), int_val, out=out, mode="clip")
+
+    @staticmethod
+    def decode_interleaved(buffer, n_channels=1):
+        """Decodes a block of interleaved big endian ADC samples to mV in one step.
+
+        The FastDAC sends one two byte sample per channel for every step, so a block of ``steps" samples is laid out as ch0, ch1, ..., ch0, ch1, ... The block is viewed as big endian unsigned shorts and reshaped so that each row holds one channel.
+
+        Parameters
+        ----------
+        buffer : bytes-like 
+            A whole number of interleaved samples, i.e. the length is a multiple of 2*n_channels
+
+        n_channels : int, optional 
+            The number of ADC channels interleaved in the buffer
+
+        Returns
+        -------
+        A numpy array of shape (n_channels, steps). Row k holds the readings of the k-th channel in mV.
+        """
+        raw = np.frombuffer(buffer, dtype=">u2")
+        assert len(raw) % n_channels == 0, "Buffer does not hold a whole number of samples per channel"
+        # transpose first so that every channel row is contiguous
+        return FastDAC.map_int16_to_mV(np.ascontiguousarray(raw.reshape(-1, n_channels).T))
+
+    @staticmethod
+    def SPEC_ANA_command(channels=[0, ], steps=10):
+        """Formats the SPEC_ANA command that reads steps points from each of the ADC channels
+
+        Returns
+        -------
+        A byte string 
+        """
+        cmd = "SPEC_ANA,{},{}\r".format(
+            "".join(str(ac) for ac in channels), steps)
+        return bytes(cmd, "ascii")
+
+    @staticmethod
+    def INT_RAMP_command(DAC_channels=[0, ], ADC_channels=[0, ],  steps=1000, rampRanges={0: [-100, 100], }):
+        """Formats the INT_RAMP command. See `RAMP_AND_READ` for the parameters.
+
+        Returns
+        -------
+        A byte string 
+        """
+        cmd = "INT_RAMP,"
+        cmd = cmd + "".join(str(dc) for dc in DAC_channels) + ","
+        cmd = cmd + "".join(str(ac) for ac in ADC_channels) + ","
+
+        for key in rampRanges.keys():
+            cmd = cmd + str(rampRanges[key][0]) + ","
+        for key in rampRanges.keys():
+            cmd = cmd + str(rampRanges[key][1]) + ","
+
+        cmd = cmd + str(steps) + "\r"
+        return bytes(cmd, "ascii")
+
     def STOP(self):
         """Stops any sweeps or reads that the FastDAC is currently doing
         """
@@ -254,7 +509,8 @@ class FastDAC():
         -------
         A string, for example:'DAC-ADC_AD7734-AD5764_UNIT5_PIDTEST'
         """
-        return self.query(b"*IDN?\r")
+        self.state.idn = self.query(b"*IDN?\r")
+        return self.state.idn
 
     def RDY(self):
         return self.query(b"*RDY?\r")
@@ -262,6 +518,7 @@ class FastDAC():
     def RESET(self):
         """Resets the ADCs, and sets the range to default +/-10 V
         """
+        self.state.invalidate()
         return self.query(b"RESET\r")
 
     def GET_DAC(self, channel=0):
@@ -280,7 +537,9 @@ class FastDAC():
             The DAC reading you are looking for     
         """
         cmd = "GET_DAC,{}\r".format(channel)
-        return self.query(bytes(cmd, "ascii"))
+        reading = self.query(bytes(cmd, "ascii"))
+        self._remember(self.state.DAC, channel, reading, float)
+        return reading
 
     def GET_ADC(self, channel=0):
         """Reads the current DAC output in mV
@@ -303,8 +562,106 @@ class FastDAC():
         cmd = "GET_ADC,{}\r".format(channel)
         return self.query(bytes(cmd, "ascii"))
 
-    def SPEC_ANA(self, channels=[0, ], steps=10):
-        """Reads a number of points equal to ``steps" from each ADC channels as specified in channels in mV.
+    def snapshot(self, ADC_channels=range(8), DAC_channels=range(4)):
+        """Reads the ADC inputs and DAC outputs with a single pipelined batch of GET_ADC and GET_DAC commands.
+
+        Parameters
+        ----------
+        ADC_channels : iterable, optional 
+            The ADC channels to read
+
+        DAC_channels : iterable, optional 
+            The DAC channels to read
+
+        Returns
+        -------
+        A dictionary {"ADC": {channel: reading}, "DAC": {channel: reading}}. The readings are the strings returned by GET_ADC and GET_DAC.
+        """
+        ADC_channels = list(ADC_channels)
+        DAC_channels = list(DAC_channels)
+        commands = [bytes("GET_ADC,{}\r".format(c), "ascii") for c in ADC_channels]
+        commands += [bytes("GET_DAC,{}\r".format(c), "ascii") for c in DAC_channels]
+
+        replies = self.query_batch(commands)
+        for c, reading in zip(DAC_channels, replies[len(ADC_channels):]):
+            self._remember(self.state.DAC, c, reading, float)
+        return {"ADC": dict(zip(ADC_channels, replies[:len(ADC_channels)])),
+                "DAC": dict(zip(DAC_channels, replies[len(ADC_channels):]))}
+
+    @staticmethod
+    def _remember(cache, key, reply, cast):
+        """Stores cast(reply) in cache, or forgets key if the reply cannot be cast
+        """
+        try:
+            cache[key] = cast(reply)
+        except (TypeError, ValueError):
+            cache.pop(key, None)
+
+    def refresh(self, ADC_channels=range(8), DAC_channels=range(4)):
+        """Reads the IDN, conversion times and DAC outputs back from the instrument into `state`, with a single pipelined batch of queries.
+
+        Parameters
+        ----------
+        ADC_channels : iterable, optional 
+            The ADC channels to read the conversion time of
+
+        DAC_channels : iterable, optional 
+            The DAC channels to read
+
+        Returns
+        -------
+        The `InstrumentState`
+        """
+        ADC_channels = list(ADC_channels)
+        DAC_channels = list(DAC_channels)
+        commands = [b"*IDN?\r"]
+        commands += [bytes("READ_CONVERT_TIME,{}\r".format(c), "ascii") for c in ADC_channels]
+        commands += [bytes("GET_DAC,{}\r".format(c), "ascii") for c in DAC_channels]
+
+        replies = self.query_batch(commands)
+        self.state = InstrumentState()
+        self.state.idn = replies[0]
+        for c, reply in zip(ADC_channels, replies[1:1 + len(ADC_channels)]):
+            self._remember(self.state.convert_times, c, reply, int)
+        for c, reply in zip(DAC_channels, replies[1 + len(ADC_channels):]):
+            self._remember(self.state.DAC, c, reply, float)
+        return self.state
+
+    def calibration_of(self, channel):
+        """The (gain, offset) that `calibration` applies to an ADC channel at its current conversion time. The conversion time is queried if it is not known, so call this before starting a stream.
+        """
+        if self.calibration is None:
+            return (1.0, 0.0)
+        return self.calibration.get(channel, self.convert_time(channel))
+
+    def convert_time(self, channel=0):
+        """The conversion time of an ADC channel in uS, queried only if it is not known already
+
+        Returns
+        -------
+        An integer
+        """
+        if channel not in self.state.convert_times:
+            reply = self.READ_CONVERT_TIME(channel)
+            assert channel in self.state.convert_times, "Bad conversion time received: {!r}".format(reply)
+        return self.state.convert_times[channel]
+
+    def DAC_output(self, channel=0):
+        """The output of a DAC channel in mV, queried only if it is not known already
+
+        Returns
+        -------
+        A float
+        """
+        if channel not in self.state.DAC:
+            reply = self.GET_DAC(channel)
+            assert channel in self.state.DAC, "Bad DAC reading received: {!r}".format(reply)
+        return self.state.DAC[channel]
+
+    def start_SPEC_ANA(self, channels=[0, ], steps=10, capacity=2**20, convert_time=None, latency=0.02):
+        """Sends SPEC_ANA and starts a `SerialReader` thread that drains the serial port into a ring buffer of raw samples.
+
+        The serial port is left open. Once the reader has finished, the FastDAC's closing message is still waiting to be read with `self.ser.readline()`.
 
         Parameters
         ----------
@@ -312,48 +669,238 @@ class FastDAC():
             The ADC channels to read
 
         steps : int, optional
-            The number of data points to read 
+            The number of data points to read per channel
 
-        Returns 
+        capacity : int, optional
+            The size of the ring buffer in samples. Consumers that fall further behind than this lose data.
+
+        convert_time : int, optional
+            The conversion time per channel in uS. The reader sizes its reads from the resulting byte rate, 2 bytes per conversion time; otherwise it measures the rate first.
+
+        latency : float, optional
+            The target seconds of data per read, see `SerialReader`
+
+        Returns
         -------
-        A dictionary where the keys represents the adc channels that was read, and the value is a numpy array of readings. 
+        The running `SerialReader`. Its `ring` holds the interleaved raw samples, and its `stats` (also kept as `self.stats`) count them. 
         """
-        cmd = "SPEC_ANA,{},{}\r".format(
-            "".join(str(ac) for ac in channels), steps)
+        cmd = FastDAC.SPEC_ANA_command(channels, steps)
 
         if self.verbose:
             print(cmd)
-        if not self.ser.is_open:
-            self.ser.open()
+        self._open()
+
+        self.ser.write(cmd)
+
+        # the channels are converted one after the other, one sample each
+        byte_rate = None if convert_time is None else 2/(convert_time*1e-6)
+        reader = SerialReader(self.ser, RingBuffer(capacity),
+                              nbytes=steps*len(channels)*2, byte_rate=byte_rate, latency=latency)
+        self.stats = reader.stats
+        reader.start()
+        return reader
+
+    @staticmethod
+    def iter_channels(reader, channels, timeout=0.05, chunk=2**16):
+        """Pulls raw samples from a `SerialReader` ring buffer until the stream ends, and splits them by channel with a `Demultiplexer`.
+
+        Only whole steps are pulled, so every chunk holds the same number of samples for every channel. If samples are overwritten before they are read, splitting resumes at the next whole step.
 
-        self.ser.write(bytes(cmd, "ascii"))
+        The samples are copied into one scratch buffer that is reused for every chunk, so the yielded arrays are only valid until the next chunk is requested. Copy them to keep them.
 
-        channel_readings = {ac: list() for ac in channels}
+        The time spent waiting for samples, and the time the caller spends on every chunk, are added to the reader's `AcquisitionStats`.
+
+        Parameters
+        ----------
+        reader : SerialReader
+            As returned by `start_SPEC_ANA`
+
+        channels : list 
+            The ADC channels interleaved in the stream, in order
+
+        timeout : float, optional
+            How long to wait for new data before checking again whether the stream has ended
+
+        chunk : int, optional
+            The most samples yielded at once, over all channels
+
+        Yields
+        ------
+        A dictionary where the keys are the adc channels, and the values are numpy array views of the new raw samples
+        """
+        cursor = reader.ring.cursor()
+        n = len(channels)
+        demux = Demultiplexer(channels, reader.ring.dtype)
+        scratch = np.empty(max(n, chunk // n*n), dtype=reader.ring.dtype)
+        stats = reader.stats
+        mark = time.perf_counter()
+        while True:
+            ended = reader.ring.closed
+            whole = cursor.available // n*n
+            if whole:
+                raw = cursor.read(max_items=whole, out=scratch)
+                yield demux.split(raw, cursor.position - len(raw))
+            elif ended:
+                break
+            else:
+                # wait for a whole step
+                now = time.perf_counter()
+                stats.decode_time += now - mark
+                reader.ring.wait(cursor.position + n - 1, timeout)
+                mark = time.perf_counter()
+                stats.wait_time += mark - now
+
+        stats.decode_time += time.perf_counter() - mark
+        stats.dropped = cursor.dropped + demux.skipped
+        if cursor.dropped:
+            print("{} samples were overwritten before they could be read".format(cursor.dropped))
+        if reader.error is not None:
+            raise reader.error
+
+    def _open_writers(self, channels, convert_time, h5path=None, raw=False):
+        """Makes the writers that store a SPEC_ANA stream while it is acquired
+
+        Parameters
+        ----------
+        channels : list 
+            The ADC channels in the stream
+
+        convert_time : int
+            The conversion time per channel in uS
+
+        h5path : str or Path, optional
+            Append the stream to a new group of this HDF5 file. See `HDF5Writer.HDF5StreamWriter`.
+
+        raw : bool, optional
+            Store raw 16 bit samples instead of mV
+
+        Returns
+        -------
+        A list of writers, each with an append(chunk) and a close(complete, stats) method
+        """
+        writers = list()
+        if h5path is not None:
+            # imported here as h5py is optional
+            from HDF5Writer import HDF5StreamWriter
+            calibrations = {ac: self.calibration_of(ac) for ac in channels}
+            writers.append(HDF5StreamWriter(
+                h5path, channels, convert_time, raw=raw, calibrations=calibrations))
+        return writers
+
+    def _abort_stream(self, reader, writers=(), capture=None):
+        """Ends a stream that was left early, on an error or an interrupt, so that the next command gets its own reply.
+
+        Stops the reader and the instrument, throws away whatever the instrument sent in the meantime, and closes the writers and the raw capture as incomplete.
+
+        Parameters
+        ----------
+        reader : SerialReader
+            The reader draining the stream
+
+        writers : list, optional
+            The writers made by `_open_writers`
+
+        capture : RawCaptureWriter, optional
+            The raw capture made by `_start_capture`
+        """
         try:
-            while self.ser.in_waiting > 15 or len(channel_readings[0]) < steps:
-                for channel in channels:
-                    buffer = ""
-                    if self.ser.in_waiting > 35:
-                        buffer = self.ser.read(20)
-                    else:
-                        buffer = self.ser.read(2)
-                    # separate the buffer
-                    info = [buffer[i:i+2] for i in range(0, len(buffer), 2)]
-                    for two_b in info:
-                        int_val = FastDAC.two_bytes_to_int(two_b)
-                        voltage_reading = FastDAC.map_int16_to_mV(int_val)
-                        channel_readings[channel].append(voltage_reading)
+            if reader.is_alive():
+                reader.stop()
+                reader.join()
+            if self.ser.is_open:
+                self.STOP()
+                # the samples still in flight, and the closing message
+                time.sleep(0.1)
+                self.ser.reset_input_buffer()
+        finally:
+            self._close()
+            for writer in writers:
+                writer.close(complete=False, stats=reader.stats)
+            if capture is not None:
+                capture.close(complete=False, stats=reader.stats)
+
+    def _start_capture(self, reader, channels, convert_time, rawpath, calibrations=None):
+        """Starts writing the raw stream of reader byte for byte to rawpath, from a separate thread. See `RawCapture.RawCaptureWriter`. The calibrations, {adc_channel: (gain, offset)}, are stored in the sidecar.
+
+        Returns
+        -------
+        The running RawCaptureWriter, or None if rawpath is None 
+        """
+        if rawpath is None:
+            return None
+        from RawCapture import RawCaptureWriter
+        capture = RawCaptureWriter(
+            rawpath, channels, convert_time, self.baudrate, calibrations=calibrations)
+        capture.follow(reader)
+        return capture
+
+    def SPEC_ANA(self, channels=[0, ], steps=10, h5path=None, raw=False, rawpath=None, traces=False):
+        """Reads a number of points equal to ``steps" from each ADC channels as specified in channels in mV.
+
+        Parameters
+        ----------
+        channels : list, optional 
+            The ADC channels to read
+
+        steps : int, optional
+            The number of data points to read 
+
+        h5path : str or Path, optional 
+            If given, the readings are also appended to a new group of this HDF5 file as they arrive
+
+        raw : bool, optional 
+            Store raw 16 bit samples in the HDF5 file instead of mV 
+
+        rawpath : str or Path, optional 
+            If given, the raw stream is also written byte for byte to this .bin file, with a .json sidecar. Open it with `RawCapture.load`.
+
+        traces : bool, optional 
+            Return `ADCTrace` objects, which hold the raw counts and convert to mV on access, instead of numpy arrays
+
+        Returns 
+        -------
+        A dictionary where the keys represents the adc channels that was read, and the value is a numpy array of readings. 
+        """
+        writers = list()
+        convert_time = self.state.convert_times.get(channels[0])
+        if h5path is not None or rawpath is not None:
+            convert_time = self.convert_time(channels[0])
+            writers = self._open_writers(channels, convert_time, h5path, raw)
+
+        calibrations = {ac: self.calibration_of(ac) for ac in channels}
+        reader = self.start_SPEC_ANA(channels, steps, convert_time=convert_time)
+        capture = self._start_capture(reader, channels, convert_time, rawpath, calibrations)
+
+        sample_period = None if convert_time is None else convert_time*1e-6*len(channels)
+        channel_readings = {ac: ADCTrace(ac, sample_period, *calibrations[ac]) for ac in channels}
+        for trace in channel_readings.values():
+            trace.stats = reader.stats
+        try:
+            for chunk in FastDAC.iter_channels(reader, channels):
+                for ac, raw_samples in chunk.items():
+                    channel_readings[ac].append(raw_samples)
+                for writer in writers:
+                    writer.append(chunk)
         except:
-            self.ser.close()
+            self._abort_stream(reader, writers, capture)
             raise
         # .decode('ascii').rstrip('\r\n')
         data = self.ser.readline()
-        self.ser.close()
+        self._close()
         print(data)
+        if self.verbose:
+            print(reader.stats)
+        for writer in writers:
+            writer.close(stats=reader.stats)
+        if capture is not None:
+            capture.close(stats=reader.stats)
+
+        if traces:
+            return channel_readings
 
         # convert to numpy array
         for k in channel_readings.keys():
-            channel_readings[k] = np.array(channel_readings[k])
+            channel_readings[k] = channel_readings[k].mV()
 
         return channel_readings
 
@@ -384,7 +931,11 @@ class FastDAC():
         """
         cmd = "RAMP_SMART,{},{},{}\r".format(channel, setPoint, rampRate)
 
-        return self.query(bytes(cmd, "ascii"))
+        self.state.DAC.pop(channel, None)
+        reply = self.query(bytes(cmd, "ascii"))
+        if reply == "RAMP_FINISHED":
+            self.state.DAC[channel] = float(setPoint)
+        return reply
 
     def RAMP_AND_READ(self, DAC_channels=[0, ], ADC_channels=[0, ],  steps=1000, rampRanges={0: [-100, 100], }):
         """Ramps the specified DAC channels, and read on the specified ADC channels at the same time. 
@@ -410,41 +961,96 @@ class FastDAC():
         "NOP" : str
             Something is wrong
         """
-        cmd = "INT_RAMP,"
-        cmd = cmd + "".join(str(dc) for dc in DAC_channels) + ","
-        cmd = cmd + "".join(str(ac) for ac in ADC_channels) + ","
-
-        for key in rampRanges.keys():
-            cmd = cmd + str(rampRanges[key][0]) + ","
-        for key in rampRanges.keys():
-            cmd = cmd + str(rampRanges[key][1]) + ","
-
-        cmd = cmd + str(steps) + "\r"
+        cmd = FastDAC.INT_RAMP_command(
+            DAC_channels, ADC_channels, steps, rampRanges)
 
         if self.verbose:
             print(cmd)
-        if not self.ser.is_open:
-            self.ser.open()
+        calibrations = [self.calibration_of(ac) for ac in ADC_channels]
+        self._open()
 
-        self.ser.write(bytes(cmd, "ascii"))
+        for dc in DAC_channels:
+            self.state.DAC.pop(dc, None)
+        self.ser.write(cmd)
 
-        channel_readings = {ac: np.zeros(steps) for ac in ADC_channels}
+        stats = self.stats = AcquisitionStats(steps*len(ADC_channels))
         try:
-            for i in range(0, steps):
-                for channel in ADC_channels:
-                    int_val = FastDAC.two_bytes_to_int(self.ser.read(2))
-                    voltage_reading = FastDAC.map_int16_to_mV(int_val)
-                    channel_readings[channel][i] = voltage_reading
+            buffer = self.read_block(steps*len(ADC_channels)*2, stats=stats)
         except:
-            self.ser.close()
+            self._close()
             raise
 
+        since = time.perf_counter()
+        if self.calibration is None:
+            readings = FastDAC.decode_interleaved(buffer, len(ADC_channels))
+        else:
+            raw = np.frombuffer(buffer, dtype=">u2").reshape(-1, len(ADC_channels)).T
+            readings = [FastDAC.map_int16_to_mV_calibrated(raw[k], *calibrations[k]) for k in range(len(ADC_channels))]
+        channel_readings = {ac: readings[k] for k, ac in enumerate(ADC_channels)}
+        stats.decode_time += time.perf_counter() - since
+
         data = self.ser.readline().decode('ascii').rstrip('\r\n')
-        self.ser.close()
+        self._close()
         print(data)
+        if self.verbose:
+            print(stats)
+        if data == "RAMP_FINISHED":
+            # every DAC channel ends the ramp on its final value
+            for dc in DAC_channels:
+                self.state.DAC[dc] = float(rampRanges[dc][1])
 
         return channel_readings
 
+    def iter_RAMP_AND_READ(self, DAC_channels=[0, ], ADC_channels=[0, ],  steps=1000, rampRanges={0: [-100, 100], }, block_steps=1000, keep=False, capacity=2**20):
+        """Starts the same ramp as `RAMP_AND_READ`, but hands the readings over block by block while the ramp is running.
+
+        Example
+        -------
+        ramp = fd.iter_RAMP_AND_READ([0], [0, 1], 100000, {0: [-1000, 1000]}, keep=True)
+        for step_range, block in ramp:
+            plot(step_range, block[0])
+        readings = ramp.result()
+
+        Parameters
+        ----------
+        DAC_channels, ADC_channels, steps, rampRanges : 
+            As for `RAMP_AND_READ`
+
+        block_steps : int, optional 
+            The most steps per block 
+
+        keep : bool, optional 
+            Also keep every reading (as `ADCTrace`, 2 bytes per sample), so that `RampStream.result` can return the whole ramp. Memory stays constant if False.
+
+        capacity : int, optional 
+            The size of the ring buffer in samples, see `start_SPEC_ANA`
+
+        Returns
+        -------
+        A `RampStream`. Iterate over it to run the ramp. Its `stats` are updated as the blocks arrive.
+        """
+        cmd = FastDAC.INT_RAMP_command(
+            DAC_channels, ADC_channels, steps, rampRanges)
+
+        if self.verbose:
+            print(cmd)
+        calibrations = {ac: self.calibration_of(ac) for ac in ADC_channels}
+        self._open()
+
+        for dc in DAC_channels:
+            self.state.DAC.pop(dc, None)
+        self.ser.write(cmd)
+
+        # the ADC channels are converted one after the other every step
+        byte_rate = None
+        if all(ac in self.state.convert_times for ac in ADC_channels):
+            byte_rate = 2*len(ADC_channels)/(sum(self.state.convert_times[ac] for ac in ADC_channels)*1e-6)
+        reader = SerialReader(self.ser, RingBuffer(capacity),
+                              nbytes=steps*len(ADC_channels)*2, byte_rate=byte_rate)
+        self.stats = reader.stats
+        reader.start()
+        return RampStream(self, reader, ADC_channels, steps, DAC_channels, rampRanges, block_steps, keep, calibrations)
+
     def SET_CONVERT_TIME(self, channel=0, convertTime=1000):
         """Sets the conversion time in microseconds. This is the time required to digitize the analog signal.  
 
@@ -465,7 +1071,9 @@ class FastDAC():
         """
 
         cmd = "CONVERT_TIME,{},{}\r".format(channel, convertTime)
-        return self.query(bytes(cmd, "ascii"))
+        reply = self.query(bytes(cmd, "ascii"))
+        self._remember(self.state.convert_times, channel, reply, int)
+        return reply
 
     def READ_CONVERT_TIME(self, channel=0):
         """Returns the convert time on the specified channel in uS
@@ -482,7 +1090,9 @@ class FastDAC():
         """
 
         cmd = "READ_CONVERT_TIME,{}\r".format(channel)
-        return self.query(bytes(cmd, "ascii"))
+        reply = self.query(bytes(cmd, "ascii"))
+        self._remember(self.state.convert_times, channel, reply, int)
+        return reply
 
     # This function would be better placed in a testing suite!
     # def check_conversion_time(self, channels=[0, 1, 2, 3], reps=100):
@@ -507,23 +1117,51 @@ class FastDAC():
 
     #     return read
 
-    def read_vs_time(self, fig, duration: int, channels=[0, ]):
+    def read_vs_time(self, fig, duration: int, channels=[0, ], h5path=None, raw=False, rawpath=None, window=None, points=2000, refresh_rate=10.0):
         """Reads the specified channel in chuncks, for a number of seconds as specified in duration.
 
+        A `SerialReader` thread drains the serial port while this thread plots, so a slow plot never backs up the serial port. The plot is a `LivePlot`: it shows the min/max decimated readings of a rolling window, so the cost of a redraw does not grow with the length of the capture.
+
         Parameters
         ----------
+        fig : plotly FigureWidget or None
+            The readings of channels[0] are drawn into fig.data[0] as they arrive
+
         duration : int
             The number of seconds to read ADC channels specifed for 
 
         channels : list, optional 
             The ADC channels on the fastDAC to read from 
+
+        h5path : str or Path, optional 
+            If given, the readings of every channel are appended to a new group of this HDF5 file as they arrive, so the capture survives a crash and is not limited by RAM
+
+        raw : bool, optional 
+            Store raw 16 bit samples in the HDF5 file instead of mV 
+
+        rawpath : str or Path, optional 
+            If given, the raw stream is also written byte for byte to this .bin file, with a .json sidecar. Open it with `RawCapture.load`.
+
+        window : float, optional 
+            The number of most recent seconds plotted. The whole duration is plotted if None.
+
+        points : int, optional 
+            The most points plotted 
+
+        refresh_rate : float, optional 
+            The most plot redraws per second 
+
+        Returns 
+        -------
+        A dictionary where the keys represents the adc channels that was read, and the value is an `ADCTrace` of the readings. 
         """
         logging.debug('Starting')
         assert len(channels) > 0, "What? No ADC channel selected \U0001F923"
 
         c_time = list()
         for c in channels:
-            t_read = int(self.READ_CONVERT_TIME(channel=c))
+            # known from a previous command, or queried once
+            t_read = self.convert_time(channel=c)
             if t_read not in c_time:
                 c_time.append(t_read)
 
@@ -534,80 +1172,104 @@ class FastDAC():
         measure_freq = c_freq/len(channels)
         steps = int(np.round(measure_freq*duration))
 
-        cmd = "SPEC_ANA,{},{}\r".format(
-            "".join(str(ac) for ac in channels), steps)
-
-        if self.verbose:
-            print(cmd)
-        if not self.ser.is_open:
-            self.ser.open()
-
-        self.ser.write(bytes(cmd, "ascii"))
-        channel_readings = {ac: list() for ac in channels}
-
-        x_array = np.linspace(0, duration, steps)
-
+        plot = None
+        if fig is not None:
+            plot = LivePlot(fig, 1/measure_freq, window or duration, points, refresh_rate)
+
+        calibrations = {ac: self.calibration_of(ac) for ac in channels}
+        writers = self._open_writers(channels, c_time[0], h5path, raw)
+        reader = self.start_SPEC_ANA(channels, steps, convert_time=c_time[0])
+        capture = self._start_capture(reader, channels, c_time[0], rawpath, calibrations)
+        traces = {ac: ADCTrace(ac, 1/measure_freq, *calibrations[ac]) for ac in channels}
+        for trace in traces.values():
+            trace.stats = reader.stats
+        # decoded readings are written here instead of a new array per chunk
+        mV = np.empty(2**16)
         try:
-            if not self.ser.is_open:
-                self.ser.open()
-            time.sleep(0.1)
-            while self.ser.in_waiting > 15 or len(channel_readings[channels[0]]) < steps:
-                new_readings = []
-                # print(self.ser.in_waiting)
-                for channel in channels:
-                    buffer = ""
-                    waiting = self.ser.in_waiting
-                    if waiting > 1000 + 15:
-                        buffer = self.ser.read(1000)
-                    elif self.ser.in_waiting > 200+15:
-                        buffer = self.ser.read(200)
-                    else:
-                        buffer = self.ser.read(2)
-
-                    big_end_arr = np.ndarray(
-                        shape=(int(len(buffer)/2)), dtype='>u2', buffer=buffer)
-                    voltage_reading = FastDAC.map_int16_to_mV(
-                        big_end_arr).tolist()
-                    new_readings += voltage_reading
-
-                channel_readings[channel] += new_readings
-
-                if fig is not None:
-
-                    scatter = fig.data[0]
-                    with fig.batch_update():
-                        scatter.x += tuple(x_array[len(scatter.x)
-                                           :len(scatter.x) + len(new_readings)])
-                        scatter.y += tuple(new_readings)
-
-        except Exception as e:
-            print(e)
-            self.ser.close()
+            for chunk in FastDAC.iter_channels(reader, channels, chunk=len(mV)):
+                for ac, raw in chunk.items():
+                    traces[ac].append(raw)
+                raw = chunk[channels[0]]
+                new_readings = FastDAC.map_int16_to_mV_calibrated(raw, *calibrations[channels[0]], out=mV[:len(raw)])
+
+                if plot is not None:
+                    plot.append(new_readings)
+
+                for writer in writers:
+                    writer.append(chunk)
+
+        except BaseException as e:
+            # KeyboardInterrupt included, the usual way to end a capture early
+            print(repr(e))
+            self._abort_stream(reader, writers, capture)
             raise
 
+        if plot is not None:
+            plot.refresh()
         self.STOP()
         data = self.ser.readline()
         print(data)
-        self.ser.close()
+        if self.verbose:
+            print(reader.stats)
+        self._close()
+        for writer in writers:
+            writer.close(stats=reader.stats)
+        if capture is not None:
+            capture.close(stats=reader.stats)
         logging.debug('Exiting')
+        return traces
 
-    def FDacSpectrumAnalyzer(self, duration: int, PDS_fig, TimeSeries_fig=None,  repeat=0, channels=[0, ], ):
-        """Reads the specified channel in chuncks, for a number of seconds as specified in duration.
+    def FDacSpectrumAnalyzer(self, duration: int, PDS_fig, TimeSeries_fig=None,  repeat=0, channels=[0, ], nperseg=256, average="mean", alpha=0.1, refresh_rate=5.0, pairs=None, Coherence_fig=None):
+        """Reads the specified channel in chuncks, for a number of seconds as specified in duration, repeat times.
+
+        The power spectral density of every channel is estimated by a `StreamingWelch` as the readings arrive, and averaged over every repeat. Only the running average is kept, so the number of segments averaged is limited neither by memory nor by the number of plot traces. All channels come from the same capture, so the cross-spectral density and coherence of channel pairs cost no extra instrument time.
 
         Parameters
         ----------
         duration : int
             The number of seconds to read ADC channels specifed for 
 
+        PDS_fig : plotly FigureWidget or None
+            The PSD of channels[i] in dB is drawn into PDS_fig.data[i], live. Missing traces are added.
+
+        TimeSeries_fig : plotly FigureWidget, optional 
+            The readings of channels[0] are drawn into TimeSeries_fig.data[0], as by `read_vs_time`
+
+        repeat : int, optional 
+            The number of captures of duration seconds to average 
+
         channels : list, optional 
             The ADC channels on the fastDAC to read from 
+
+        nperseg : int, optional 
+            The length of every Welch segment 
+
+        average : "mean" or "exponential", optional 
+            See `StreamingWelch` 
+
+        alpha : float, optional 
+            The weight of a new segment in the exponential average 
+
+        refresh_rate : float, optional 
+            The most PSD plot redraws per second 
+
+        pairs : list of tuples or True, optional 
+            The channel pairs (a, b) to estimate the cross-spectral density and coherence of. True for every pair. 
+
+        Coherence_fig : plotly FigureWidget, optional 
+            The coherence of pairs[i] is drawn into Coherence_fig.data[i]. Missing traces are added. 
+
+        Returns 
+        -------
+        The `StreamingWelch` holding the averaged PSDs 
         """
         logging.debug('Starting')
         assert len(channels) > 0, "What? No ADC channel selected \U0001F923"
 
         c_time = list()
         for c in channels:
-            t_read = int(self.READ_CONVERT_TIME(channel=c))
+            # known from a previous command, or queried once
+            t_read = self.convert_time(channel=c)
             if t_read not in c_time:
                 c_time.append(t_read)
 
@@ -618,77 +1280,166 @@ class FastDAC():
         measure_freq = c_freq/len(channels)
         steps = int(np.round(measure_freq*duration))
 
-        cmd = "SPEC_ANA,{},{}\r".format(
-            "".join(str(ac) for ac in channels), steps)
-
-        if self.verbose:
-            print(cmd)
+        calibrations = {ac: self.calibration_of(ac) for ac in channels}
+        welch = StreamingWelch(measure_freq, channels, nperseg, average=average, alpha=alpha, pairs=pairs)
+        if Coherence_fig is not None:
+            assert welch.pairs, "What? No channel pairs selected \U0001F923"
+        # one trace per channel or pair, reused by every repeat
+        for fig, names in ((PDS_fig, ["ADC{}".format(ac) for ac in channels]),
+                           (Coherence_fig, ["ADC{}-ADC{}".format(a, b) for a, b in welch.pairs])):
+            if fig is not None:
+                for name in names[len(fig.data):]:
+                    fig.add_scatter(x=[],
+                                    y=[],
+                                    line=dict(width=0.5),
+                                    name=name
+                                    )
 
-        x_array = np.linspace(0, duration, steps)
+        def draw_psd():
+            if not welch.segments:
+                return
+            if PDS_fig is not None:
+                with PDS_fig.batch_update():
+                    for i, ac in enumerate(channels):
+                        PDS_fig.data[i].x = welch.frequencies
+                        PDS_fig.data[i].y = 10*np.log10(welch.psd(ac)/1)
+            if Coherence_fig is not None:
+                with Coherence_fig.batch_update():
+                    for i, (a, b) in enumerate(welch.pairs):
+                        Coherence_fig.data[i].x = welch.frequencies
+                        Coherence_fig.data[i].y = welch.coherence(a, b)
 
         for i in range(repeat):
-            if not self.ser.is_open:
-                self.ser.open()
-
-            self.ser.write(bytes(cmd, "ascii"))
-            channel_readings = {ac: list() for ac in channels}
+            reader = self.start_SPEC_ANA(channels, steps, convert_time=c_time[0])
+            # segments do not span the gap between two captures
+            welch.restart()
+            plot = None
+            if TimeSeries_fig is not None:
+                plot = LivePlot(TimeSeries_fig, 1/measure_freq, duration)
+            last_draw = -np.inf
+            # decoded readings are written here instead of new arrays per chunk
+            mV = {ac: np.empty(2**16) for ac in channels}
 
             try:
-                if not self.ser.is_open:
-                    self.ser.open()
-                time.sleep(0.1)
-                while self.ser.in_waiting > 15 or len(channel_readings[channels[0]]) < steps:
-                    new_readings = []
-                    for channel in channels:
-                        buffer = ""
-                        waiting = self.ser.in_waiting
-                        if waiting > 1000 + 15:
-                            buffer = self.ser.read(1000)
-                        elif self.ser.in_waiting > 200+15:
-                            buffer = self.ser.read(200)
-                        else:
-                            buffer = self.ser.read(2)
-
-                        info = [buffer[i:i+2]
-                                for i in range(0, len(buffer), 2)]
-
-                        for two_b in info:
-                            int_val = FastDAC.two_bytes_to_int(two_b)
-                            voltage_reading = FastDAC.map_int16_to_mV(int_val)
-                            new_readings.append(voltage_reading)
-
-                    channel_readings[channel] += new_readings
-                    if TimeSeries_fig is not None:
-                        scatter = TimeSeries_fig.data[0]
-                        with TimeSeries_fig.batch_update():
-                            scatter.x += tuple(x_array[len(scatter.x)
-                                               :len(scatter.x) + len(new_readings)])
-                            scatter.y += tuple(new_readings)
-
-            except Exception as e:
-                print(e)
-                self.ser.close()
+                for chunk in FastDAC.iter_channels(reader, channels, chunk=2**16):
+                    readings = {ac: FastDAC.map_int16_to_mV_calibrated(raw, *calibrations[ac], out=mV[ac][:len(raw)])
+                                for ac, raw in chunk.items()}
+                    welch.append(readings)
+
+                    if plot is not None:
+                        plot.append(readings[channels[0]])
+                    if time.perf_counter() - last_draw >= 1/refresh_rate:
+                        draw_psd()
+                        last_draw = time.perf_counter()
+
+            except BaseException as e:
+                print(repr(e))
+                self._abort_stream(reader)
                 raise
 
-            if PDS_fig is not None:
-                PDS_fig.add_scatter(x=[],
-                                    y=[],
-                                    line=dict(width=0.5)
-                                    )
-                scatter = PDS_fig.data[i]
-                with PDS_fig.batch_update():
-                    f, Pxx_den = signal.welch(
-                        channel_readings[channels[0]], fs=measure_freq,)
-                    scatter.x = tuple(f)
-                    scatter.y = tuple(10*np.log10(Pxx_den/1))
-                    # scatter.y = tuple(Pxx_den)
+            if plot is not None:
+                plot.refresh()
+            draw_psd()
 
             self.STOP()
             data = self.ser.readline()
             print(data)
+            if self.verbose:
+                print(reader.stats)
 
-            self.ser.close()
+            self._close()
         logging.debug('Exiting')
+        return welch
+
+class RampStream():
+
+    def __init__(self, fastdac, reader, ADC_channels, steps, DAC_channels, rampRanges, block_steps=1000, keep=False, calibrations=None):
+        """The readings of a running INT_RAMP, block by block. Made by `FastDAC.iter_RAMP_AND_READ`.
+
+        Iterating yields (step_range, block) tuples as the readings arrive: step_range is the range of ramp steps in the block, and block is a dictionary where the keys are the adc channels and the values are numpy arrays of readings in mV. Call `close`, or use the stream as a context manager, to stop the ramp early.
+        """
+        self.fastdac = fastdac
+        self.reader = reader
+        self.ADC_channels = list(ADC_channels)
+        self.steps = steps
+        self.DAC_channels = list(DAC_channels)
+        self.rampRanges = rampRanges
+        self.block_steps = block_steps
+        # ADC channel: (gain, offset)
+        self.calibrations = calibrations or {ac: (1.0, 0.0) for ac in self.ADC_channels}
+        self.traces = {ac: ADCTrace(ac, None, *self.calibrations[ac]) for ac in self.ADC_channels} if keep else None
+        # updated as the blocks arrive
+        self.stats = reader.stats
+        for trace in (self.traces or dict()).values():
+            trace.stats = self.stats
+        # number of steps handed over so far
+        self.position = 0
+        self.finished = False
+        self._blocks = self._run()
+
+    def __iter__(self):
+        return self._blocks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        fd = self.fastdac
+        n = len(self.ADC_channels)
+        try:
+            for chunk in FastDAC.iter_channels(self.reader, self.ADC_channels, chunk=self.block_steps*n):
+                if self.traces is not None:
+                    for ac, raw in chunk.items():
+                        self.traces[ac].append(raw)
+                m = len(chunk[self.ADC_channels[0]])
+                step_range = range(self.position, self.position + m)
+                self.position += m
+                yield step_range, {ac: FastDAC.map_int16_to_mV_calibrated(raw, *self.calibrations[ac]) for ac, raw in chunk.items()}
+        except:
+            # an error, or the loop was left early
+            self._abort()
+            raise
+
+        data = fd.ser.readline().decode('ascii').rstrip('\r\n')
+        fd._close()
+        print(data)
+        if fd.verbose:
+            print(self.stats)
+        self.finished = True
+        if data == "RAMP_FINISHED":
+            # every DAC channel ends the ramp on its final value
+            for dc in self.DAC_channels:
+                fd.state.DAC[dc] = float(self.rampRanges[dc][1])
+
+    def _abort(self):
+        """Stops the ramp and the reader, and throws away whatever the instrument sent in the meantime, so the next command gets its own reply
+        """
+        self.fastdac._abort_stream(self.reader)
+
+    def close(self):
+        """Stops the ramp if it is still running
+        """
+        if inspect.getgeneratorstate(self._blocks) == inspect.GEN_CREATED:
+            # closing a generator that never ran skips its cleanup
+            self._blocks.close()
+            self._abort()
+        else:
+            self._blocks.close()
+
+    def result(self):
+        """Runs the rest of the ramp, and returns every reading. Requires keep=True.
+
+        Returns
+        -------
+        As `FastDAC.RAMP_AND_READ`: a dictionary where the keys represents the adc channels that was read, and the value is a numpy array of readings. 
+        """
+        assert self.traces is not None, "The readings were not kept; pass keep=True"
+        for _ in self._blocks:
+            pass
+        return {ac: trace.mV() for ac, trace in self.traces.items()}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,371 @@
+"""
+This module provides a software FastDAC behind a pseudo-terminal, so the acquisition code paths of `FastDAC` and `PIDFastDAC` can be run and profiled on any Linux box without hardware.
+
+The emulator speaks the same protocol as the instrument: ASCII commands terminated by a carriage return, CR/LF terminated replies, big endian ADC samples for SPEC_ANA and INT_RAMP, and little endian (PV, CO) float frames followed by the 0xA5, 0x5A sync bytes while the PID loop runs. Data is produced at the rate implied by the conversion times and the baud rate.
+
+Example
+-------
+with FastDACEmulator() as emu:
+    fd = FastDAC(emu.port, 1750000, timeout=1)
+    fd.SPEC_ANA([0, 1], 1000)
+"""
+import os
+import pty
+import tty
+import time
+import select
+import struct
+import threading
+import numpy as np
+
+# the closest settings the AD7734 allows, in uS
+MIN_CONVERT_TIME = 82
+MAX_CONVERT_TIME = 2686
+PID_SYNC = b"\xa5\x5a"
+
+
+class FastDACEmulator():
+
+    def __init__(self, baudrate=1750000, idn="DAC-ADC_AD7734-AD5764_EMULATOR", realtime=True, noise=1.0, pickup=(60.0, 50.0), seed=None):
+        """Makes a new emulated FastDAC. Call `start` (or use a with block) to create the pseudo-terminal.
+
+        Parameters
+        ----------
+        baudrate : int, optional
+            The emulated baud rate. Streams never go faster than baudrate/10 bytes per second.
+
+        idn : str, optional
+            The reply to *IDN?
+
+        realtime : bool, optional
+            If True, data is produced at the rate implied by the conversion times and the baud rate. If False, data is produced as fast as the client can read it, which is useful to find where the host CPU becomes the limit.
+
+        noise : float, optional
+            The standard deviation of the white noise added to every ADC reading in mV
+
+        pickup : tuple, optional
+            (frequency in Hz, amplitude in mV) of a sinusoid added to every ADC reading, e.g. mains pickup
+
+        seed : int, optional
+            Seeds the noise generator
+        """
+        self.baudrate = baudrate
+        self.idn = idn
+        self.realtime = realtime
+        self.noise = noise
+        self.pickup = pickup
+        self.rng = np.random.default_rng(seed)
+
+        self.convert_times = {ch: 1000 for ch in range(8)}
+        self.dac = {ch: 0.0 for ch in range(4)}
+        self.pid = {"kp": 0.1, "ki": 1.0, "kd": 0.0, "setp": 0.0,
+                    "limit": [-10000.0, 10000.0], "dir": 1, "slew": 10000000.0}
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._pending = b""
+        # when the emulator was started; the time axis of the simulated signals
+        self._t0 = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """Creates the pseudo-terminal and starts answering commands in a background thread
+
+        Returns
+        -------
+        The name of the serial port to connect to, e.g. "/dev/pts/3"
+        """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._t0 = time.perf_counter()
+        self._thread = threading.Thread(
+            name="FastDACEmulator", target=self._run, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        """Stops the emulator and closes the pseudo-terminal
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    # ---------------------------------------------------------------- I/O
+
+    def _receive(self, timeout):
+        """Appends whatever the client sent within timeout seconds to the pending input
+        """
+        ready, _, _ = select.select([self._master], [], [], timeout)
+        if ready:
+            try:
+                self._pending += os.read(self._master, 4096)
+            except OSError:
+                # nobody has the port open
+                time.sleep(timeout)
+
+    def _next_command(self):
+        """Pops the next carriage return terminated command, or returns None
+        """
+        if b"\r" not in self._pending:
+            return None
+        cmd, self._pending = self._pending.split(b"\r", 1)
+        return cmd.strip(b"\n ").decode("ascii", errors="replace")
+
+    def _send(self, data):
+        view = memoryview(data)
+        while len(view) and self._running:
+            try:
+                _, ready, _ = select.select([], [self._master], [], 0.1)
+                if ready:
+                    view = view[os.write(self._master, view):]
+            except OSError:
+                return
+
+    def _reply(self, text):
+        self._send(bytes("{}\r\n".format(text), "ascii"))
+
+    def _stop_requested(self, stop_commands):
+        """Checks, without blocking, whether the client has sent one of stop_commands. Other commands are left pending.
+        """
+        self._receive(0)
+        for stop in stop_commands:
+            token = bytes(stop, "ascii") + b"\r"
+            if token in self._pending:
+                self._pending = self._pending.replace(token, b"", 1)
+                return True
+        return False
+
+    def _run(self):
+        while self._running:
+            cmd = self._next_command()
+            if cmd is None:
+                self._receive(0.05)
+                continue
+            if cmd:
+                self._handle(cmd)
+
+    # ------------------------------------------------------------ signals
+
+    def _adc_mV(self, channels, t, dac_values=None):
+        """Simulated ADC readings in mV, shape (len(t), len(channels))
+
+        ADC channel c reads back DAC channel c % 4, plus pickup and noise.
+        """
+        t = np.asarray(t, dtype=float)
+        readings = np.empty((len(t), len(channels)))
+        frequency, amplitude = self.pickup
+        pickup = amplitude*np.sin(2*np.pi*frequency*t)
+        for k, c in enumerate(channels):
+            dac = self.dac[c % 4] if dac_values is None else dac_values[c % 4]
+            readings[:, k] = dac + pickup + self.rng.normal(0, self.noise, len(t))
+        return readings
+
+    @staticmethod
+    def mV_to_int16(mV):
+        """The inverse of `FastDAC.map_int16_to_mV`, rounded and clipped to 16 bits
+        """
+        return np.clip(np.round((np.asarray(mV) + 10000.0)*65536.0/20000.0), 0, 65535).astype(">u2")
+
+    def _stream(self, frames, frame_size, frame_period, make_frames, stop_commands=("STOP", )):
+        """Writes frames at the rate set by frame_period and the baud rate, until all frames are written or a stop command arrives.
+
+        Parameters
+        ----------
+        frames : int or None
+            The number of frames to write. Streams until stopped if None.
+
+        frame_size : int
+            The number of bytes per frame
+
+        frame_period : float
+            Seconds per frame set by the conversion times
+
+        make_frames : callable
+            make_frames(first, n) returns the bytes of frames first to first + n
+
+        Returns
+        -------
+        True if every frame was written
+        """
+        period = max(frame_period, frame_size*10.0/self.baudrate)
+        # at most ~5 ms, or 16 kB, of data per write
+        chunk = max(1, min(int(0.005/period), 16384 // frame_size))
+        start = time.perf_counter()
+        sent = 0
+        while self._running and (frames is None or sent < frames):
+            if self._stop_requested(stop_commands):
+                return False
+            if self.realtime:
+                due = int((time.perf_counter() - start)/period) + 1
+            else:
+                due = sent + chunk
+            n = min(due - sent, chunk)
+            if frames is not None:
+                n = min(n, frames - sent)
+            if n <= 0:
+                time.sleep(min(period, 0.001))
+                continue
+            self._send(make_frames(sent, n))
+            sent += n
+        return sent == frames
+
+    # ----------------------------------------------------------- commands
+
+    def _handle(self, cmd):
+        name, _, args = cmd.partition(",")
+        args = args.split(",") if args else []
+        handler = getattr(self, "_cmd_" + name.replace("*", "").replace("?", ""), None)
+        if handler is None:
+            self._reply("NOP")
+            return
+        try:
+            handler(*args)
+        except (TypeError, ValueError, KeyError, IndexError):
+            self._reply("NOP")
+
+    def _cmd_IDN(self):
+        self._reply(self.idn)
+
+    def _cmd_RDY(self):
+        self._reply("READY")
+
+    def _cmd_NOP(self):
+        self._reply("NOP")
+
+    def _cmd_STOP(self):
+        # nothing is running
+        pass
+
+    def _cmd_RESET(self):
+        self._reply("RESET_COMPLETED")
+
+    def _cmd_GET_DAC(self, channel):
+        self._reply("{:.4f}".format(self.dac[int(channel)]))
+
+    def _cmd_GET_ADC(self, channel):
+        t = time.perf_counter() - self._t0
+        self._reply("{:.4f}".format(self._adc_mV([int(channel)], [t])[0, 0]))
+
+    def _cmd_CONVERT_TIME(self, channel, convert_time):
+        actual = int(np.clip(int(float(convert_time)), MIN_CONVERT_TIME, MAX_CONVERT_TIME))
+        self.convert_times[int(channel)] = actual
+        self._reply(actual)
+
+    def _cmd_READ_CONVERT_TIME(self, channel):
+        self._reply(self.convert_times[int(channel)])
+
+    def _cmd_RAMP_SMART(self, channel, setPoint, rampRate):
+        channel, setPoint, rampRate = int(channel), float(setPoint), float(rampRate)
+        if self.realtime and rampRate > 0:
+            time.sleep(abs(setPoint - self.dac[channel])/rampRate)
+        self.dac[channel] = setPoint
+        self._reply("RAMP_FINISHED")
+
+    def _cmd_SPEC_ANA(self, adcs, steps):
+        channels = [int(c) for c in adcs]
+        steps = int(steps)
+        period = sum(self.convert_times[c] for c in channels)*1e-6
+        t0 = time.perf_counter() - self._t0
+
+        def make_frames(first, n):
+            t = t0 + (first + np.arange(n))*period
+            return FastDACEmulator.mV_to_int16(self._adc_mV(channels, t)).tobytes()
+
+        if self._stream(steps, 2*len(channels), period, make_frames):
+            self._reply("READ_FINISHED")
+
+    def _cmd_INT_RAMP(self, dacs, adcs, *ranges_and_steps):
+        dac_channels = [int(c) for c in dacs]
+        channels = [int(c) for c in adcs]
+        steps = int(ranges_and_steps[-1])
+        starts = [float(v) for v in ranges_and_steps[:len(dac_channels)]]
+        ends = [float(v) for v in ranges_and_steps[len(dac_channels):2*len(dac_channels)]]
+        period = sum(self.convert_times[c] for c in channels)*1e-6
+        t0 = time.perf_counter() - self._t0
+
+        def make_frames(first, n):
+            i = first + np.arange(n)
+            values = dict(self.dac)
+            for dc, start, end in zip(dac_channels, starts, ends):
+                values[dc] = start + (end - start)*i/max(steps - 1, 1)
+            mV = np.empty((n, len(channels)))
+            for k, c in enumerate(channels):
+                mV[:, k] = self._adc_mV([c], t0 + i*period, values)[:, 0]
+            return FastDACEmulator.mV_to_int16(mV).tobytes()
+
+        finished = self._stream(steps, 2*len(channels), period, make_frames)
+        for dc, end in zip(dac_channels, ends):
+            self.dac[dc] = end
+        if finished:
+            self._reply("RAMP_FINISHED")
+
+    def _cmd_START_PID(self):
+        p = self.pid
+        period = self.convert_times[0]*1e-6
+        # a first order process with a 10 ms time constant, driven by DAC 0
+        state = {"x": 0.0, "co": self.dac[0], "integral": 0.0, "error": 0.0}
+
+        def make_frames(first, n):
+            frames = bytearray()
+            noise = self.rng.normal(0, self.noise, n)
+            max_step = p["slew"]*period
+            for k in range(n):
+                pv = state["x"] + noise[k]
+                error = (p["setp"] - pv)*(1 if p["dir"] else -1)
+                state["integral"] += error*period
+                derivative = (error - state["error"])/period
+                state["error"] = error
+                target = p["kp"]*error + p["ki"]*state["integral"] + p["kd"]*derivative
+                co = state["co"] + min(max(target - state["co"], -max_step), max_step)
+                state["co"] = min(max(co, p["limit"][0]), p["limit"][1])
+                state["x"] += (state["co"] - state["x"])*min(period/0.01, 1.0)
+                frames += struct.pack("<ff", pv, state["co"]) + PID_SYNC
+            return bytes(frames)
+
+        self._stream(None, 10, period, make_frames, stop_commands=("STOP_PID", "STOP"))
+        self.dac[0] = state["co"]
+
+    def _cmd_STOP_PID(self):
+        # nothing is running
+        pass
+
+    def _cmd_SET_PID_TUNE(self, kp, ki, kd):
+        self.pid.update(kp=float(kp), ki=float(ki), kd=float(kd))
+
+    def _cmd_SET_PID_SETP(self, setp):
+        self.pid["setp"] = float(setp)
+
+    def _cmd_SET_PID_LIMS(self, lower, upper):
+        self.pid["limit"] = [float(lower), float(upper)]
+
+    def _cmd_SET_PID_DIR(self, dir):
+        self.pid["dir"] = int(dir)
+
+    def _cmd_SET_PID_SLEW(self, slew):
+        self.pid["slew"] = float(slew)
+
+
+if __name__ == "__main__":
+    emu = FastDACEmulator()
+    print("Emulated FastDAC on {}. Press Ctrl+C to stop.".format(emu.start()))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emu.stop()
@@ -0,0 +1,172 @@
+"""
+This module streams FastDAC readings into an HDF5 file while they are being acquired, so the length of a capture is limited by disk space rather than RAM, and a crash part way through keeps everything written so far.
+
+Requires `h5py`.
+"""
+import time
+import numpy as np
+from datetime import datetime
+from FastDAC import FastDAC
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class HDF5StreamWriter():
+
+    def __init__(self, path, channels, convert_time, name=None, raw=False, chunk_size=65536, flush_interval=1.0, attrs=None, calibrations=None):
+        """Creates one chunked, resizable dataset per ADC channel in a new group of an HDF5 file.
+
+        Parameters
+        ----------
+        path : str or Path
+            The HDF5 file. Created if it does not exist, otherwise the new group is added to it.
+
+        channels : list
+            The ADC channels to be stored. Every channel gets a dataset called "ADC<channel>".
+
+        convert_time : int
+            The conversion time per channel in uS
+
+        name : str, optional
+            The name of the group holding the datasets. Defaults to the start time.
+
+        raw : bool, optional
+            Store the raw 16 bit samples instead of mV. Use `FastDAC.map_int16_to_mV` to convert them when reading.
+
+        chunk_size : int, optional
+            The number of samples per HDF5 chunk
+
+        flush_interval : float, optional
+            The most seconds between flushes to disk
+
+        attrs : dict, optional
+            Extra attributes to store on the group
+
+        calibrations : dict, optional
+            The keys are adc channels, and the values are the (gain, offset) applied to their readings, see `Calibration`. Stored as "gain" and "offset" attributes of every dataset; raw samples are stored uncalibrated and calibrated by `load`.
+        """
+        assert h5py is not None, "h5py is required to write HDF5 files"
+        self.channels = list(channels)
+        self.raw = raw
+        self.calibrations = {ac: (1.0, 0.0) for ac in self.channels}
+        self.calibrations.update(calibrations or dict())
+        self.flush_interval = flush_interval
+        self.samples = 0
+        # decoded readings are written here instead of a new array per chunk
+        self._mV = np.empty(0)
+
+        start = datetime.now()
+        self.file = h5py.File(path, "a", libver="latest")
+        self.group = self.file.create_group(name or start.strftime("%Y%m%d-%H%M%S.%f"))
+        self.group.attrs["channels"] = self.channels
+        self.group.attrs["convert_time_us"] = convert_time
+        self.group.attrs["sample_period_s"] = convert_time*1e-6*len(self.channels)
+        self.group.attrs["start_time"] = start.isoformat()
+        self.group.attrs["start_timestamp"] = start.timestamp()
+        self.group.attrs["raw"] = raw
+        if raw:
+            self.group.attrs["units"] = "ADC counts, mV = counts*20000/65536 - 10000"
+        else:
+            self.group.attrs["units"] = "mV"
+        self.group.attrs["complete"] = False
+        for k, v in (attrs or dict()).items():
+            self.group.attrs[k] = v
+
+        self.datasets = {ac: self.group.create_dataset("ADC{}".format(ac), shape=(0, ), maxshape=(None, ),
+                                                       chunks=(chunk_size, ), dtype=np.uint16 if raw else np.float64)
+                         for ac in self.channels}
+        for ac, (gain, offset) in self.calibrations.items():
+            self.datasets[ac].attrs["gain"] = gain
+            self.datasets[ac].attrs["offset"] = offset
+        # readers can open the file while it is being written, and the file
+        # stays consistent if the writer dies
+        self.file.swmr_mode = True
+        self._last_flush = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+    def append(self, chunk):
+        """Appends new samples to every channel.
+
+        Parameters
+        ----------
+        chunk : dict
+            The keys are the adc channels, and the values are numpy arrays of raw samples as yielded by `FastDAC.iter_channels`
+        """
+        for ac, samples in chunk.items():
+            dataset = self.datasets[ac]
+            n = dataset.shape[0]
+            dataset.resize((n + len(samples), ))
+            if self.raw:
+                dataset[n:] = samples
+                continue
+            if len(self._mV) < len(samples):
+                self._mV = np.empty(len(samples))
+            dataset[n:] = FastDAC.map_int16_to_mV_calibrated(samples, *self.calibrations[ac], out=self._mV[:len(samples)])
+        self.samples = min(d.shape[0] for d in self.datasets.values())
+
+        if time.perf_counter() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes everything appended so far to disk
+        """
+        self.file.flush()
+        self._last_flush = time.perf_counter()
+
+    def close(self, complete=True, stats=None):
+        """Records the number of samples and closes the file
+
+        Parameters
+        ----------
+        complete : bool, optional
+            Whether the capture finished normally
+
+        stats : AcquisitionStats, optional
+            Stored as "stats_<name>" attributes of the group
+        """
+        if not self.file:
+            return
+        self.group.attrs["samples"] = self.samples
+        self.group.attrs["complete"] = complete
+        if stats is not None:
+            for k, v in stats.as_dict().items():
+                if v is not None:
+                    self.group.attrs["stats_" + k] = v
+        self.file.close()
+
+
+def load(path, name=None):
+    """Reads a capture written by `HDF5StreamWriter` back into memory.
+
+    Parameters
+    ----------
+    path : str or Path
+
+    name : str, optional
+        The group to read. Defaults to the most recent one.
+
+    Returns
+    -------
+    A dictionary {adc_channel: numpy array of readings in mV}, and a dictionary of the attributes
+    """
+    assert h5py is not None, "h5py is required to read HDF5 files"
+    with h5py.File(path, "r", libver="latest", swmr=True) as f:
+        group = f[name or sorted(f.keys())[-1]]
+        attrs = dict(group.attrs)
+        readings = dict()
+        for ac in attrs["channels"]:
+            dataset = group["ADC{}".format(ac)]
+            data = dataset[...]
+            if attrs["raw"]:
+                # captures written before calibrations were stored have no gain
+                data = FastDAC.map_int16_to_mV_calibrated(data, dataset.attrs.get("gain", 1.0), dataset.attrs.get("offset", 0.0))
+            readings[int(ac)] = data
+    return readings, attrs
@@ -0,0 +1,168 @@
+"""
+This module keeps live plots of FastDAC readings responsive, however long the capture.
+
+Instead of appending every reading to a plotly trace, which re-sends the whole growing trace on every update, a `LivePlot` keeps the minimum and maximum of every bin of a rolling window (`MinMaxDecimator`), and redraws that fixed number of points at a capped refresh rate. Min/max decimation keeps every spike and the noise envelope visible, and works chunk by chunk without revisiting old samples.
+
+Example
+-------
+plot = LivePlot(fig, sample_period=1e-4, window=10)
+plot.append(mV)     # for every new chunk of readings
+plot.refresh()      # draw whatever was held back by the refresh rate
+"""
+import time
+import numpy as np
+
+
+class MinMaxDecimator():
+
+    def __init__(self, sample_period, window, points=2000):
+        """Reduces a stream of readings to the minimum and maximum of every bin of a rolling window.
+
+        Parameters
+        ----------
+        sample_period : float
+            Seconds between two readings
+
+        window : float
+            The number of most recent seconds to keep
+
+        points : int, optional
+            The most points `xy` returns. Every bin contributes two.
+        """
+        self.sample_period = sample_period
+        # one bin is kept for the bin being filled
+        self.bins = max(1, points // 2 - 1)
+        # readings per bin
+        self.k = max(1, int(np.ceil(window / sample_period / self.bins)))
+        # completed bins, kept in a ring of self.bins entries
+        self.count = 0
+        self._imin = np.zeros(self.bins, dtype=np.int64)
+        self._imax = np.zeros(self.bins, dtype=np.int64)
+        self._vmin = np.zeros(self.bins)
+        self._vmax = np.zeros(self.bins)
+        # the bin being filled
+        self._partial = np.empty(self.k)
+        self._fill = 0
+
+    @property
+    def samples(self):
+        """The total number of readings appended"""
+        return self.count*self.k + self._fill
+
+    def _push(self, blocks):
+        """Stores the min and max of every row of blocks, a (bins, k) array
+        """
+        first = self.count*self.k + np.arange(len(blocks))*self.k
+        # only the most recent bins fit
+        blocks, first = blocks[-self.bins:], first[-self.bins:]
+        amin = blocks.argmin(axis=1)
+        amax = blocks.argmax(axis=1)
+        rows = np.arange(len(blocks))
+        slots = (first // self.k) % self.bins
+        self._imin[slots] = first + amin
+        self._imax[slots] = first + amax
+        self._vmin[slots] = blocks[rows, amin]
+        self._vmax[slots] = blocks[rows, amax]
+
+    def append(self, y):
+        """Adds new readings
+
+        Parameters
+        ----------
+        y : numpy array
+        """
+        y = np.asarray(y)
+        i = 0
+        if self._fill:
+            i = min(len(y), self.k - self._fill)
+            self._partial[self._fill:self._fill + i] = y[:i]
+            self._fill += i
+            if self._fill < self.k:
+                return
+            self._push(self._partial[np.newaxis])
+            self.count += 1
+            self._fill = 0
+
+        m = (len(y) - i) // self.k
+        if m:
+            self._push(y[i:i + m*self.k].reshape(m, self.k))
+            self.count += m
+            i += m*self.k
+
+        rest = len(y) - i
+        self._partial[:rest] = y[i:]
+        self._fill = rest
+
+    def xy(self):
+        """Returns the decimated window as (time in seconds, reading) numpy arrays, in time order
+        """
+        n = min(self.count, self.bins)
+        slots = np.arange(self.count - n, self.count) % self.bins
+        imin, imax = self._imin[slots], self._imax[slots]
+        vmin, vmax = self._vmin[slots], self._vmax[slots]
+        if self._fill:
+            partial = self._partial[:self._fill]
+            a, b = partial.argmin(), partial.argmax()
+            start = self.count*self.k
+            imin = np.append(imin, start + a)
+            imax = np.append(imax, start + b)
+            vmin = np.append(vmin, partial[a])
+            vmax = np.append(vmax, partial[b])
+
+        # within a bin, draw whichever extreme came first first
+        min_first = imin <= imax
+        x = np.stack((np.where(min_first, imin, imax), np.where(min_first, imax, imin)), axis=1)
+        y = np.stack((np.where(min_first, vmin, vmax), np.where(min_first, vmax, vmin)), axis=1)
+        return x.ravel()*self.sample_period, y.ravel()
+
+
+class LivePlot():
+
+    def __init__(self, fig, sample_period, window, points=2000, refresh_rate=10.0, trace=0):
+        """Draws the most recent readings of a channel into a trace of a plotly FigureWidget, with a bounded number of points and a capped refresh rate.
+
+        Parameters
+        ----------
+        fig : plotly FigureWidget
+
+        sample_period : float
+            Seconds between two readings
+
+        window : float
+            The number of most recent seconds shown
+
+        points : int, optional
+            The most points drawn
+
+        refresh_rate : float, optional
+            The most redraws per second
+
+        trace : int, optional
+            The index of the trace in fig.data to draw into
+        """
+        self.fig = fig
+        self.trace = trace
+        self.decimator = MinMaxDecimator(sample_period, window, points)
+        self.min_interval = 1.0/refresh_rate
+        self._last = -np.inf
+
+    def append(self, y):
+        """Adds new readings, and redraws if the last redraw is old enough
+
+        Parameters
+        ----------
+        y : numpy array
+        """
+        self.decimator.append(y)
+        if time.perf_counter() - self._last >= self.min_interval:
+            self.refresh()
+
+    def refresh(self):
+        """Redraws the plot now
+        """
+        x, y = self.decimator.xy()
+        scatter = self.fig.data[self.trace]
+        with self.fig.batch_update():
+            scatter.x = x
+            scatter.y = y
+        self._last = time.perf_counter()
@@ -0,0 +1,169 @@
+"""
+This module drives several FastDACs at once, for rigs where 2-4 units sit on separate serial ports.
+
+`MultiFastDAC` prepares every command first, then sends them back to back so the instruments start within a few hundred microseconds of each other. Every port is drained by its own `SerialReader` thread, so the wall time is that of the slowest instrument rather than the sum of all of them.
+"""
+import time
+from contextlib import ExitStack
+from FastDAC import FastDAC
+from Acquisition import RingBuffer, SerialReader, Demultiplexer
+
+
+class MultiFastDAC():
+
+    def __init__(self, fastdacs):
+        """Groups FastDAC (or PIDFastDAC) objects for synchronized acquisition.
+
+        Parameters
+        ----------
+        fastdacs : list
+            Connected `FastDAC` objects. Results are returned in this order.
+        """
+        assert len(fastdacs) > 0, "What? No FastDAC given \U0001F923"
+        self.fastdacs = list(fastdacs)
+        # perf_counter time at which each instrument was sent its command
+        self.start_times = list()
+
+    @property
+    def skew(self):
+        """The time in seconds between sending the first and the last command of the most recent acquisition"""
+        if not self.start_times:
+            return None
+        return max(self.start_times) - min(self.start_times)
+
+    def _per_device(self, arg):
+        """Broadcasts an argument shared by all instruments to a list with one entry per instrument. A list of lists (or of dictionaries) already has one entry per instrument.
+        """
+        if isinstance(arg, (list, tuple)) and len(arg) > 0 and all(isinstance(a, (list, tuple, dict)) for a in arg):
+            assert len(arg) == len(self.fastdacs), "What? {} per instrument arguments for {} instruments \U0001F923".format(len(arg), len(self.fastdacs))
+            return list(arg)
+        return [arg] * len(self.fastdacs)
+
+    def _acquire(self, commands, nbytes, channels):
+        """Sends one command per instrument back to back, drains every port concurrently, and splits the samples by channel.
+
+        Parameters
+        ----------
+        commands : list of byte str
+            The command for each instrument
+
+        nbytes : list of int
+            The number of bytes each instrument streams back
+
+        channels : list of list
+            The ADC channels each instrument streams back
+
+        Returns
+        -------
+        A list with one {adc_channel: raw samples} dictionary per instrument, and a list of the message each instrument closed its stream with, e.g. "RAMP_FINISHED"
+        """
+        with ExitStack() as stack:
+            for fd in self.fastdacs:
+                stack.enter_context(fd.session())
+
+            # every ring holds the whole capture with room to spare, so nothing
+            # is overwritten before it is read at the end
+            readers = [SerialReader(fd.ser, RingBuffer(n), nbytes=n,
+                                    name="SerialReader[{}]".format(fd.port))
+                       for fd, n in zip(self.fastdacs, nbytes)]
+            for fd, reader in zip(self.fastdacs, readers):
+                fd.stats = reader.stats
+
+            self.start_times = list()
+            try:
+                for fd, cmd, reader in zip(self.fastdacs, commands, readers):
+                    fd.ser.write(cmd)
+                    self.start_times.append(time.perf_counter())
+                    reader.start()
+                for reader in readers:
+                    reader.join()
+            except:
+                for fd, reader in zip(self.fastdacs, readers):
+                    fd._abort_stream(reader)
+                raise
+
+            results = list()
+            replies = list()
+            for fd, chans, reader in zip(self.fastdacs, channels, readers):
+                if reader.error is not None:
+                    raise reader.error
+                data = fd.ser.readline()
+                if fd.verbose:
+                    print(data)
+                replies.append(data.decode('ascii').rstrip('\r\n'))
+                results.append(Demultiplexer(chans).split(reader.ring.cursor().read()))
+        return results, replies
+
+    def _calibrations(self, channels):
+        """The (gain, offset) of every ADC channel of every instrument, see `FastDAC.calibration_of`
+        """
+        return [{ac: fd.calibration_of(ac) for ac in chans} for fd, chans in zip(self.fastdacs, channels)]
+
+    @staticmethod
+    def _align(results, calibrations):
+        """Truncates every channel of every instrument to the same number of samples, and converts to mV
+        """
+        steps = min(len(raw) for result in results for raw in result.values())
+        return [{ac: FastDAC.map_int16_to_mV_calibrated(raw[:steps], *cal[ac]) for ac, raw in result.items()}
+                for result, cal in zip(results, calibrations)]
+
+    def SPEC_ANA(self, channels=[0, ], steps=10):
+        """Runs SPEC_ANA on every instrument at the same time.
+
+        Parameters
+        ----------
+        channels : list, optional
+            The ADC channels to read, either one list shared by all instruments or a list of lists with one entry per instrument
+
+        steps : int, optional
+            The number of data points to read per channel
+
+        Returns
+        -------
+        A list with one dictionary per instrument, in the order given to the constructor. The keys are the adc channels, and the values are numpy arrays of readings in mV. Sample i of every array was taken at the same step.
+        """
+        channels = self._per_device(channels)
+        commands = [FastDAC.SPEC_ANA_command(chans, steps) for chans in channels]
+        nbytes = [steps*len(chans)*2 for chans in channels]
+        calibrations = self._calibrations(channels)
+        results, replies = self._acquire(commands, nbytes, channels)
+        return MultiFastDAC._align(results, calibrations)
+
+    def RAMP_AND_READ(self, DAC_channels=[0, ], ADC_channels=[0, ], steps=1000, rampRanges={0: [-100, 100], }):
+        """Runs INT_RAMP on every instrument at the same time. See `FastDAC.RAMP_AND_READ`.
+
+        Parameters
+        ----------
+        DAC_channels : list, optional
+            One list shared by all instruments, or a list of lists with one entry per instrument
+
+        ADC_channels : list, optional
+            One list shared by all instruments, or a list of lists with one entry per instrument
+
+        steps : int, optional
+            The number of steps every DAC channel takes
+
+        rampRanges : dict or list of dict, optional
+            One dictionary shared by all instruments, or a list with one dictionary per instrument
+
+        Returns
+        -------
+        A list with one dictionary per instrument, in the order given to the constructor. The keys are the adc channels, and the values are numpy arrays of readings in mV.
+        """
+        DAC_channels = self._per_device(DAC_channels)
+        ADC_channels = self._per_device(ADC_channels)
+        rampRanges = self._per_device(rampRanges)
+        commands = [FastDAC.INT_RAMP_command(dc, ac, steps, rr)
+                    for dc, ac, rr in zip(DAC_channels, ADC_channels, rampRanges)]
+        nbytes = [steps*len(ac)*2 for ac in ADC_channels]
+        calibrations = self._calibrations(ADC_channels)
+        for fd, dc in zip(self.fastdacs, DAC_channels):
+            for c in dc:
+                fd.state.DAC.pop(c, None)
+        results, replies = self._acquire(commands, nbytes, ADC_channels)
+        for fd, dc, rr, data in zip(self.fastdacs, DAC_channels, rampRanges, replies):
+            if data == "RAMP_FINISHED":
+                # every DAC channel ends the ramp on its final value
+                for c in dc:
+                    fd.state.DAC[c] = float(rr[c][1])
+        return MultiFastDAC._align(results, calibrations)
@@ -5,16 +5,316 @@ The `PIDFastDAC` class is a subclass of the `FastDAC` class.
 """
 from os import close
 import time
+import queue
+import threading
 import numpy as np
+from contextlib import contextmanager
 from FastDAC import FastDAC
+from Acquisition import RingBuffer, AcquisitionStats, discard_cancel
+
+# one PID telemetry frame: process variable and controller output as little
+# endian floats, followed by the two sync bytes
+PID_FRAME = np.dtype([("pv", "<f4"), ("co", "<f4"), ("sync", "u1", 2)])
+PID_SYNC = b"\xa5\x5a"
+# a decoded frame as kept by `PIDTelemetry`, with its arrival time in seconds
+TELEMETRY_FRAME = np.dtype([("time", "<f8"), ("pv", "<f4"), ("co", "<f4")])
+
+
+class PIDFrameParser():
+
+    def __init__(self):
+        """Decodes a stream of PID telemetry frames in bulk, and resynchronizes on the 0xA5, 0x5A sync bytes when bytes are lost or corrupted.
+
+        Feed it blocks of any size; a frame split across two blocks is kept until the rest of it arrives.
+        """
+        self._pending = bytearray()
+        # bytes thrown away since the stream was last in sync
+        self._skipping = 0
+        # number of frames decoded
+        self.frames = 0
+        # estimated number of frames lost to corruption
+        self.dropped = 0
+        # number of bytes thrown away while resynchronizing
+        self.skipped = 0
+
+    @property
+    def pending(self):
+        """The number of bytes held back until the rest of their frame arrives"""
+        return len(self._pending)
+
+    def feed(self, data):
+        """Decodes every complete frame in data plus whatever was left over from the last call.
+
+        Parameters
+        ----------
+        data : bytes-like
+
+        Returns
+        -------
+        A numpy array of dtype `PID_FRAME` holding the valid frames
+        """
+        buf = self._pending + data
+        decoded = [np.zeros(0, dtype=PID_FRAME)]
+        start = 0
+        size = PID_FRAME.itemsize
+        while len(buf) - start >= size:
+            n = (len(buf) - start) // size
+            frames = np.frombuffer(buf, dtype=PID_FRAME, count=n, offset=start)
+            # validate the sync bytes of every frame at once
+            bad = np.flatnonzero((frames["sync"][:, 0] != PID_SYNC[0]) |
+                                 (frames["sync"][:, 1] != PID_SYNC[1]))
+            good = n if len(bad) == 0 else bad[0]
+            decoded.append(frames[:good])
+            start += good*size
+            if good == n:
+                break
+
+            # the frame at start is corrupt
+            if start + 2*size > len(buf):
+                # wait for the next frame before deciding how to realign
+                break
+            sync = start + size - 2
+            misaligned = buf[sync + size:sync + size + 2] != PID_SYNC
+            if misaligned:
+                # bytes were lost or inserted: realign on the next sync
+                # bytes, if the frame that follows them is in sync as well
+                sync = buf.find(PID_SYNC, start)
+                while sync != -1 and sync + 2 + size <= len(buf) and buf[sync + size:sync + size + 2] != PID_SYNC:
+                    sync = buf.find(PID_SYNC, sync + 1)
+            if sync == -1:
+                # keep the last byte, it may be the first sync byte
+                self._skipping += len(buf) - 1 - start
+                start = len(buf) - 1
+                break
+            if sync + 2 + size > len(buf):
+                # wait for more data to confirm the new alignment
+                break
+            if misaligned and sync + 2 - size > start:
+                # only bytes were inserted: the frame ending on the sync bytes is whole
+                skipped = self._skipping + sync + 2 - size - start
+                # half a frame or more of junk counts as a lost frame
+                lost = int(skipped / size + 0.5)
+                start = sync + 2 - size
+            else:
+                # the frame ending on the sync bytes is cut short or corrupt
+                skipped = self._skipping + sync + 2 - start
+                lost = max(1, int(round(skipped / size)))
+                start = sync + 2
+            self._skipping = 0
+            self.skipped += skipped
+            self.dropped += lost
+
+        self._pending = buf[start:]
+        decoded = np.concatenate(decoded)
+        self.frames += len(decoded)
+        return decoded
+
+
+class PIDTelemetry(threading.Thread):
+
+    def __init__(self, pid, seconds=60, block_size=4096):
+        """A thread that reads the PID telemetry of a running PID loop without end, keeping the most recent frames in a `RingBuffer`.
+
+        Use `PIDFastDAC.start_telemetry` rather than making one directly.
+
+        Parameters
+        ----------
+        pid : PIDFastDAC
+            The instrument, with the PID loop already streaming
+
+        seconds : float, optional
+            The ring buffer holds at least this many seconds of frames, at the most frames per second the baud rate allows
+
+        block_size : int, optional
+            The most bytes read from the serial port at once
+        """
+        super().__init__(name="PIDTelemetry", daemon=True)
+        self.pid = pid
+        self.ser = pid.ser
+        self.seconds = seconds
+        # 10 bits per byte on the wire
+        frame_rate = pid.baudrate/10/PID_FRAME.itemsize
+        self.ring = RingBuffer(max(1024, int(seconds*frame_rate)), dtype=TELEMETRY_FRAME)
+        self.parser = PIDFrameParser()
+        self.block_size = block_size
+        # counts frames as samples; kept as pid.stats as well
+        self.stats = pid.stats = AcquisitionStats(None, PID_FRAME.itemsize)
+        self.error = None
+        self._subscribers = list()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # whether a read is in progress, and whether stop cancelled it
+        self._read_lock = threading.Lock()
+        self._reading = False
+        self._cancelled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    @property
+    def frames(self):
+        """The total number of frames received"""
+        return self.ring.items_written
+
+    @property
+    def dropped(self):
+        """The estimated number of frames lost to corruption"""
+        return self.parser.dropped
+
+    def subscribe(self, callback=None, maxsize=100):
+        """Delivers every new block of frames to a callback or a queue.
+
+        Callbacks run in the telemetry thread, so they should return quickly; a callback that raises is printed and unsubscribed.
+
+        Parameters
+        ----------
+        callback : callable, optional
+            Called with a numpy array of dtype `TELEMETRY_FRAME`
+
+        maxsize : int, optional
+            If no callback is given, the size of the queue that is returned. When the queue is full, its oldest block is thrown away.
+
+        Returns
+        -------
+        The callback, or a new queue.Queue of numpy arrays. Pass it to `unsubscribe` to stop the deliveries.
+        """
+        subscriber = callback if callback is not None else queue.Queue(maxsize)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Stops delivering to a callback or queue returned by `subscribe`
+        """
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def _publish(self, frames):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if isinstance(subscriber, queue.Queue):
+                while True:
+                    try:
+                        subscriber.put_nowait(frames)
+                        break
+                    except queue.Full:
+                        # a slow reader sees the newest data, not the oldest
+                        try:
+                            subscriber.get_nowait()
+                        except queue.Empty:
+                            pass
+            else:
+                try:
+                    subscriber(frames)
+                except Exception as e:
+                    print("Unsubscribed {} after it raised {!r}".format(subscriber, e))
+                    self.unsubscribe(subscriber)
+
+    def run(self):
+        buffer = bytearray(self.block_size)
+        view = memoryview(buffer)
+        stats = self.stats
+        last = time.time()
+        try:
+            while not self._stop_event.is_set():
+                in_waiting = self.ser.in_waiting
+                size = min(self.block_size, max(PID_FRAME.itemsize, in_waiting))
+                since = time.perf_counter()
+                with self._read_lock:
+                    if self._stop_event.is_set():
+                        break
+                    self._reading = True
+                try:
+                    n = self.ser.readinto(view[:size])
+                finally:
+                    self._end_read()
+                if not n:
+                    # no telemetry within the serial timeout, keep waiting
+                    continue
+                stats.read(n, since, in_waiting)
+                now = time.time()
+                decoded = self.parser.feed(view[:n])
+                stats.dropped = self.parser.dropped
+                if not len(decoded):
+                    continue
+                frames = np.empty(len(decoded), dtype=TELEMETRY_FRAME)
+                # spread the arrival time of the block over its frames
+                frames["time"] = np.linspace(last, now, len(decoded) + 1)[1:]
+                frames["pv"] = decoded["pv"]
+                frames["co"] = decoded["co"]
+                last = now
+                self.ring.write(frames.view(np.uint8))
+                self._publish(frames)
+                stats.decode_time += time.perf_counter() - stats.stopped
+        except Exception as e:
+            if not self._stop_event.is_set():
+                self.error = e
+        finally:
+            self.ring.close()
+
+    def latest(self, seconds=None):
+        """Returns the most recent frames held in the ring buffer.
+
+        Parameters
+        ----------
+        seconds : float, optional
+            Only return the frames that arrived within this many seconds. All frames held are returned if None.
+
+        Returns
+        -------
+        A numpy array of dtype `TELEMETRY_FRAME`
+        """
+        cursor = self.ring.cursor(self.ring.oldest())
+        frames = cursor.read()
+        if seconds is not None and len(frames):
+            frames = frames[frames["time"] >= time.time() - seconds]
+        return frames
+
+    def _end_read(self):
+        with self._read_lock:
+            self._reading = False
+            if self._cancelled:
+                # the read may have returned before the cancel reached it
+                discard_cancel(self.ser)
+                self._cancelled = False
+
+    def stop(self, stopPID=True):
+        """Stops reading and releases the serial port
+
+        Parameters
+        ----------
+        stopPID : bool, optional
+            Also stops the FastDAC PID loop. Otherwise the loop keeps running on the FastDAC.
+        """
+        with self._read_lock:
+            self._stop_event.set()
+            # only a read that is waiting for data is cancelled; a cancel
+            # between reads would cut the next read of the port short
+            cancel_read = getattr(self.ser, "cancel_read", None) if self._reading else None
+            if cancel_read is not None:
+                try:
+                    cancel_read()
+                    self._cancelled = True
+                except Exception:
+                    pass
+        if self.is_alive():
+            self.join()
+        if stopPID:
+            self.pid.STOP_PID()
+        self.pid._end_telemetry()
+        if self.error is not None:
+            print("PID telemetry stopped on {!r}".format(self.error))
 
 
 class PIDFastDAC(FastDAC):
 
     def __init__(self, port, baudrate, timeout, testing=False, verbose=False):
         super().__init__(port, baudrate, timeout, testing, verbose)
-        # stops the PID
-        self.STOP_PID()
         self.__kp = 0.1
         self.__ki = 1.0
         self.__kd = 0.0
@@ -23,12 +323,82 @@ class PIDFastDAC(FastDAC):
         self.__dir = 1  # default to a direct process
         # dunno why mark defaulted the slew rate to be so large...
         self.__slew = 10000000.0
+        # the session kept open by start_telemetry
+        self.__telemetry = None
+        # the last SET_PID command of every kind sent, i.e. what the instrument holds
+        self.__sent = dict()
+        # SET_PID commands held back by configure
+        self.__pending = dict()
+        self.__configuring = False
+
+        if testing:
+            # there is no instrument to configure
+            return
 
-        self.__SET_PID_DIR(dir=self.__dir)
-        self.__SET_PID_SETP(setp=self.__setp)
-        self.__SET_PID_LIMS(limit=self.__limit)
-        self.__SET_PID_SLEW(max_slewRate=self.__slew)
-        self.__SET_PID_TUNE(kp=self.__kp, ki=self.__ki, kd=self.__kd)
+        # stops the PID
+        self.STOP_PID()
+        with self.configure():
+            self.__SET_PID_DIR(dir=self.__dir)
+            self.__SET_PID_SETP(setp=self.__setp)
+            self.__SET_PID_LIMS(limit=self.__limit)
+            self.__SET_PID_SLEW(max_slewRate=self.__slew)
+            self.__SET_PID_TUNE(kp=self.__kp, ki=self.__ki, kd=self.__kd)
+
+    @contextmanager
+    def configure(self):
+        """Holds back the PID parameter changes made in the with block, and sends them together at the end, in one serial port session.
+
+        Only the last value of every parameter is sent, and only if the instrument does not hold it already; kp, ki and kd share one SET_PID_TUNE command. If the block raises, nothing is sent and the parameters are restored. Blocks can be nested; the outermost one sends.
+
+        Example
+        -------
+        with pid.configure():
+            pid.kp = 0.2
+            pid.ki = 2.0
+            pid.setp = 500
+        """
+        nested = self.__configuring
+        saved = (self.__kp, self.__ki, self.__kd, self.__setp,
+                 self.__limit, self.__dir, self.__slew)
+        self.__configuring = True
+        try:
+            yield self
+        except:
+            if not nested:
+                self.__configuring = False
+                self.__pending.clear()
+                (self.__kp, self.__ki, self.__kd, self.__setp,
+                 self.__limit, self.__dir, self.__slew) = saved
+            raise
+        if not nested:
+            self.__configuring = False
+            self.flush()
+
+    def flush(self):
+        """Sends the PID parameter changes held back by `configure`
+        """
+        commands = [(name, cmd) for name, cmd in self.__pending.items() if self.__sent.get(name) != cmd]
+        self.__pending.clear()
+        if not commands:
+            return
+        with self.session():
+            for name, cmd in commands:
+                self.write(cmd)
+                self.__sent[name] = cmd
+
+    def __send(self, cmd):
+        """Sends a SET_PID command, unless it is held back by `configure` or the instrument holds its value already
+        """
+        command = bytes(cmd, "ascii")
+        name = cmd.split(",")[0]
+        if self.__configuring:
+            self.__pending[name] = command
+            return
+        if self.__sent.get(name) == command:
+            return
+        ret = self.write(command)
+        self.__sent[name] = command
+        return ret
 
     @property
     def slew(self):
@@ -128,7 +498,7 @@ class PIDFastDAC(FastDAC):
 
         If stopPID is true, then the PID algorithm will also stop. 
 
-        The binary sync characters are 0xA5, 0x5A
+        The binary sync characters are 0xA5, 0x5A. The frames are read in blocks and decoded by a `PIDFrameParser`, which throws away corrupt frames and resynchronizes on the sync characters. The number of frames dropped is printed.
 
         Parameters
         ----------
@@ -149,6 +519,9 @@ class PIDFastDAC(FastDAC):
 
         assert n >= 0, "The number of data points cannot be negative"
 
+        # the PID loop drives the DAC output
+        self.state.invalidate(convert_times=False)
+
         if n == 0:
             # start the loop, then close the serial port
             self.write(b"START_PID\r", close = False)
@@ -156,26 +529,82 @@ class PIDFastDAC(FastDAC):
             # start the loop, dont close the serial port yet
             self.write(b"START_PID\r", close=False)
             in_out = {"in": np.zeros(n), "out": np.zeros(n)}
+            parser = PIDFrameParser()
+            buffer = bytearray(n*PID_FRAME.itemsize)
+            stats = self.stats = AcquisitionStats(n, PID_FRAME.itemsize)
+            got = 0
             try:
-                for i in range(0, n):
-                    in_val = FastDAC.four_bytes_to_float(
-                        self.ser.read(4), bigEndian=False)
-                    out_val = FastDAC.four_bytes_to_float(
-                        self.ser.read(4), bigEndian=False)
-                    self.ser.read(2)
-
-                    in_out["in"][i] = in_val
-                    in_out["out"][i] = out_val
+                while got < n:
+                    # ask for exactly the bytes still missing, so nothing
+                    # beyond frame n is taken off the port unless resyncing
+                    nbytes = max(1, (n - got)*PID_FRAME.itemsize - parser.pending)
+                    block = self.read_block(nbytes, out=buffer, stats=stats)
+                    since = time.perf_counter()
+                    frames = parser.feed(block)
+                    frames = frames[:n - got]
+                    in_out["in"][got:got + len(frames)] = frames["pv"]
+                    in_out["out"][got:got + len(frames)] = frames["co"]
+                    got += len(frames)
+                    stats.decode_time += time.perf_counter() - since
+                    stats.dropped = parser.dropped
             except:
                 # stop PID and close the serial port on error
                 self.STOP_PID()
                 raise
+            if parser.dropped:
+                print("{} PID frames were dropped, {} bytes skipped to resynchronize".format(
+                    parser.dropped, parser.skipped))
+            if self.verbose:
+                print(stats)
             # sucessful completion, stop the loop if stopPID is true
             if stopPID:
                 self.STOP_PID()
 
             return in_out
 
+    def start_telemetry(self, seconds=60, block_size=4096):
+        """Starts the PID loop, and a `PIDTelemetry` thread that reads its process variable and controller output continuously.
+
+        The most recent frames are kept in a ring buffer, so memory stays bounded however long the loop is watched. Live plots, loggers and alarms can `subscribe` to the frames as they arrive. The serial port stays open until the telemetry is stopped; the PID parameters can still be changed in the meantime.
+
+        Example
+        -------
+        with pid.start_telemetry(seconds=600) as telemetry:
+            frames = telemetry.subscribe()
+            while True:
+                block = frames.get()
+                ...
+
+        Parameters
+        ----------
+        seconds : float, optional
+            The ring buffer holds at least this many seconds of frames
+
+        block_size : int, optional
+            The most bytes read from the serial port at once
+
+        Returns
+        -------
+        The running `PIDTelemetry`. Its `stats` count the frames as they arrive.
+        """
+        self.__telemetry = self.session()
+        self.__telemetry.__enter__()
+        try:
+            self.START_PID(0)
+            telemetry = PIDTelemetry(self, seconds, block_size)
+            telemetry.start()
+        except:
+            self._end_telemetry()
+            raise
+        return telemetry
+
+    def _end_telemetry(self):
+        """Ends the session held by `start_telemetry`
+        """
+        session, self.__telemetry = self.__telemetry, None
+        if session is not None:
+            session.__exit__(None, None, None)
+
     def STOP_PID(self):
         """Stops the PID function. 
         """
@@ -193,7 +622,7 @@ class PIDFastDAC(FastDAC):
 
         """
         cmd = "SET_PID_TUNE,{},{},{}\r".format(kp, ki, kd)
-        return self.write(bytes(cmd, "ascii"))
+        return self.__send(cmd)
 
     def __SET_PID_SETP(self, setp=0):
         """Sets the PID set point in mV
@@ -205,7 +634,7 @@ class PIDFastDAC(FastDAC):
 
         """
         cmd = "SET_PID_SETP,{}\r".format(setp)
-        return self.write(bytes(cmd, "ascii"))
+        return self.__send(cmd)
 
     def __SET_PID_LIMS(self, limit=[-100, 100]):
         """Sets the DAC output limit in mV
@@ -216,7 +645,7 @@ class PIDFastDAC(FastDAC):
             limit[0] is the lower limit, limit[1] is the upper limit. The limit can be asymmetric about 0.
         """
         cmd = "SET_PID_LIMS,{},{}\r".format(limit[0], limit[1])
-        return self.write(bytes(cmd, "ascii"))
+        return self.__send(cmd)
 
     def __SET_PID_DIR(self, dir=1):
         """Sets the ``direction" of PID control.
@@ -229,7 +658,7 @@ class PIDFastDAC(FastDAC):
             dir = 0 represets a reverse process. dir = 1 represents a direct process. 
         """
         cmd = "SET_PID_DIR,{}\r".format(dir)
-        return self.write(bytes(cmd, "ascii"))
+        return self.__send(cmd)
 
     def __SET_PID_SLEW(self, max_slewRate=10000000.0):
         """Sets the maximum rate (called the slewRate just to confuse you) to ramp controller output in mV/S
@@ -241,7 +670,7 @@ class PIDFastDAC(FastDAC):
         max_slewRate : float, optional
         """
         cmd = "SET_PID_SLEW,{}\r".format(max_slewRate)
-        return self.write(bytes(cmd, "ascii"))
+        return self.__send(cmd)
 
     def setp_test(self, settle_time=10, setps=[0, 1000, 2000, 3000], steps=[1000, 2000, 2000, 2000], clip_to_limit=False):
         """ Automatically change the controller setpoint, and run the PID algoritm, and read the results. After reading all the data required, stops the PID.
@@ -0,0 +1,208 @@
+"""
+This module measures two dimensional maps, such as charge stability diagrams, with a FastDAC.
+
+A `RasterSweep` first ramps every DAC channel to its starting value with RAMP_SMART, then steps an outer DAC channel and, for every outer value, ramps the inner DAC channels with INT_RAMP while reading the ADC channels. INT_RAMP sets the DACs to the first values of its line at once, so by default the inner DAC channels jump back across their whole range between lines; sweep serpentine, or ramp them back with RAMP_SMART (flyback), to avoid that jump. The next line is sent as soon as the current line has been read off the serial port, while a second thread decodes the finished line into a preallocated (or disk-backed) array, so the length of a map is set by the instrument rather than by the host.
+
+Example
+-------
+sweep = RasterSweep(fd, outer_channel=1, outer_range=[-500, 500], outer_steps=500,
+                    inner_ranges={0: [-500, 500]}, inner_steps=500, ADC_channels=[0, 1])
+data = sweep.run()      # shape (2, 500, 500), in mV
+"""
+import time
+import queue
+import threading
+import numpy as np
+from FastDAC import FastDAC
+from Acquisition import AcquisitionStats
+
+
+class RasterSweep():
+
+    def __init__(self, fastdac, outer_channel, outer_range, outer_steps, inner_ranges, inner_steps, ADC_channels=[0, ], path=None, buffers=3, rampRate=1000, serpentine=False, flyback=False):
+        """Prepares a raster sweep. Nothing is sent to the instrument until `run`.
+
+        Parameters
+        ----------
+        fastdac : FastDAC
+
+        outer_channel : int
+            The DAC channel stepped once per line
+
+        outer_range : list
+            The first and last outer values in mV
+
+        outer_steps : int
+            The number of lines
+
+        inner_ranges : dict
+            The keys are the DAC channels ramped along every line, and the values are lists of the initial and final values in mV, as for `FastDAC.RAMP_AND_READ`
+
+        inner_steps : int
+            The number of steps along every line
+
+        ADC_channels : list, optional
+            The ADC channels to read
+
+        path : str or Path, optional
+            If given, the data is written to this .npy file through a memory map instead of being held in RAM. Open it again with `numpy.load(path, mmap_mode="r")`.
+
+        buffers : int, optional
+            The number of line buffers shared by the serial and decoding threads
+
+        rampRate : float, optional
+            The rate in mV/s at which the DAC channels are ramped to their starting values before the first line, and back between lines if flyback is True
+
+        serpentine : bool, optional
+            Sweep every other line backwards, so the inner DAC channels only move by the outer step between lines. The lines are still stored in the order of inner_values. Mind that hysteresis then differs between even and odd lines.
+
+        flyback : bool, optional
+            Ramp the inner DAC channels back to their initial values with RAMP_SMART before every line, instead of letting INT_RAMP jump there across the whole inner range. This costs the inner range/rampRate seconds per line.
+        """
+        assert outer_channel not in inner_ranges, "The outer DAC channel cannot also be ramped along the lines"
+        assert not (serpentine and flyback), "A serpentine sweep has no flyback"
+        self.fastdac = fastdac
+        self.outer_channel = outer_channel
+        self.outer_values = np.linspace(outer_range[0], outer_range[1], outer_steps)
+        self.inner_ranges = dict(inner_ranges)
+        self.inner_steps = inner_steps
+        self.inner_values = {dc: np.linspace(r[0], r[1], inner_steps) for dc, r in self.inner_ranges.items()}
+        self.ADC_channels = list(ADC_channels)
+        self.path = path
+        self.buffers = buffers
+        self.rampRate = rampRate
+        self.serpentine = serpentine
+        self.flyback = flyback
+        # number of lines decoded into data
+        self.lines_done = 0
+        self.data = None
+        self.error = None
+        # (gain, offset) of every ADC channel, see `FastDAC.calibration_of`
+        self.calibrations = [(1.0, 0.0)]*len(self.ADC_channels)
+        # the AcquisitionStats of the last run, updated line by line
+        self.stats = None
+
+    @property
+    def shape(self):
+        """(ADC channels, outer steps, inner steps)"""
+        return (len(self.ADC_channels), len(self.outer_values), self.inner_steps)
+
+    def reversed_line(self, i):
+        """Whether line i is swept from the final to the initial inner values"""
+        return self.serpentine and i % 2 == 1
+
+    def line_command(self, i):
+        """The INT_RAMP command of line i. The outer DAC is held at its value for the line.
+        """
+        ranges = dict(self.inner_ranges)
+        if self.reversed_line(i):
+            ranges = {dc: r[::-1] for dc, r in ranges.items()}
+        ranges[self.outer_channel] = [self.outer_values[i], self.outer_values[i]]
+        # INT_RAMP takes the DAC channels in order, with their ranges in the same order
+        DAC_channels = sorted(ranges)
+        return FastDAC.INT_RAMP_command(DAC_channels, self.ADC_channels, self.inner_steps,
+                                        {dc: ranges[dc] for dc in DAC_channels})
+
+    def _allocate(self):
+        if self.path is None:
+            return np.empty(self.shape)
+        return np.lib.format.open_memmap(self.path, mode="w+", dtype=np.float64, shape=self.shape)
+
+    def _decode(self, full, free):
+        """Decodes lines handed over by `run` until it sends None
+        """
+        n = len(self.ADC_channels)
+        while True:
+            item = full.get()
+            if item is None:
+                return
+            i, buffer = item
+            since = time.perf_counter()
+            try:
+                if self.error is None:
+                    raw = np.frombuffer(buffer, dtype=">u2").reshape(self.inner_steps, n).T
+                    if self.reversed_line(i):
+                        raw = raw[:, ::-1]
+                    if all(cal == (1.0, 0.0) for cal in self.calibrations):
+                        FastDAC.map_int16_to_mV_into(raw, self.data[:, i, :])
+                    else:
+                        for k, (gain, offset) in enumerate(self.calibrations):
+                            FastDAC.map_int16_to_mV_calibrated(raw[k], gain, offset, out=self.data[k, i, :])
+                    self.lines_done = i + 1
+            except Exception as e:
+                self.error = e
+            finally:
+                free.put(buffer)
+                self.stats.decode_time += time.perf_counter() - since
+
+    def _ramp_to(self, values):
+        """Ramps DAC channels to values, {DAC channel: mV}, with RAMP_SMART one after the other
+        """
+        fd = self.fastdac
+        for dc, value in values.items():
+            reply = fd.RAMP_SMART(dc, float(value), self.rampRate)
+            assert reply == "RAMP_FINISHED", "Ramping DAC {} to {} mV returned {!r}".format(dc, value, reply)
+        # the lines move them on
+        for dc in values:
+            fd.state.DAC.pop(dc, None)
+
+    def run(self):
+        """Measures the map.
+
+        Returns
+        -------
+        A numpy array (a memory map if path was given) of shape (ADC channels, outer steps, inner steps) holding the readings in mV. data[k, i, j] is ADC_channels[k] at outer_values[i] and step j of the inner ramp.
+        """
+        fd = self.fastdac
+        nbytes = self.inner_steps*len(self.ADC_channels)*2
+        self.data = self._allocate()
+        self.lines_done = 0
+        self.error = None
+        self.stats = fd.stats = AcquisitionStats(len(self.ADC_channels)*self.inner_steps*len(self.outer_values))
+        # looked up here, as the decoding thread cannot query the instrument
+        self.calibrations = [fd.calibration_of(ac) for ac in self.ADC_channels]
+
+        free = queue.Queue()
+        for k in range(self.buffers):
+            free.put(bytearray(nbytes))
+        full = queue.Queue()
+        decoder = threading.Thread(target=self._decode, args=(full, free), name="RasterSweepDecoder", daemon=True)
+        decoder.start()
+
+        inner_starts = {dc: r[0] for dc, r in self.inner_ranges.items()}
+        try:
+            with fd.session():
+                # INT_RAMP sets the DACs to the first values of a line at once,
+                # so the first line must not start with a jump
+                self._ramp_to({self.outer_channel: self.outer_values[0], **inner_starts})
+                for i in range(len(self.outer_values)):
+                    if self.error is not None:
+                        raise self.error
+                    if self.flyback and i > 0:
+                        self._ramp_to(inner_starts)
+                    since = time.perf_counter()
+                    buffer = free.get()
+                    # waiting for a free buffer means the decoder is behind
+                    self.stats.wait_time += time.perf_counter() - since
+                    fd.ser.write(self.line_command(i))
+                    try:
+                        fd.read_block(nbytes, out=buffer, stats=self.stats)
+                    except:
+                        fd.STOP()
+                        raise
+                    data = fd.ser.readline().decode('ascii').rstrip('\r\n')
+                    assert data == "RAMP_FINISHED", "Line {} ended with {!r}".format(i, data)
+                    full.put((i, buffer))
+        finally:
+            full.put(None)
+            decoder.join()
+        if self.error is not None:
+            raise self.error
+
+        fd.state.DAC[self.outer_channel] = float(self.outer_values[-1])
+        last = len(self.outer_values) - 1
+        for dc, r in self.inner_ranges.items():
+            fd.state.DAC[dc] = float(r[0] if self.reversed_line(last) else r[1])
+        if self.path is not None:
+            self.data.flush()
+        return self.data
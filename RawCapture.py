@@ -0,0 +1,222 @@
+"""
+This module records the raw big endian ADC stream of a FastDAC byte for byte to a .bin file, next to a small JSON sidecar holding everything needed to interpret it.
+
+Writing costs almost nothing, and `load` opens even a 10^8 sample capture instantly: the file is memory mapped, and samples are converted to mV only for the slices that are actually read. The raw samples are stored uncalibrated; the gain and offset of every channel (see `Calibration`) are kept in the sidecar and applied on reading.
+
+Example
+-------
+capture = RawCapture.load("Measurement_Data/noise.bin")
+capture[0][:1000]        # first 1000 readings of ADC0 in mV
+capture[0].raw[::1000]   # every 1000th raw sample, no conversion
+"""
+import json
+import threading
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+
+# map_int16_to_mV: mV = counts*FULL_SCALE_MV/COUNTS + OFFSET_MV
+FULL_SCALE_MV = 20000.0
+COUNTS = 65536.0
+OFFSET_MV = -10000.0
+
+
+def sidecar_path(path):
+    """The JSON sidecar that belongs to a .bin capture"""
+    return Path(path).with_suffix(".json")
+
+
+class RawCaptureWriter(threading.Thread):
+
+    def __init__(self, path, channels, convert_time, baudrate, chunk=2**16, calibrations=None):
+        """Writes a raw SPEC_ANA stream to disk, as its own consumer of a `SerialReader` ring buffer.
+
+        Parameters
+        ----------
+        path : str or Path
+            The .bin file to write. The sidecar is written next to it with a .json suffix.
+
+        channels : list
+            The ADC channels interleaved in the stream, in order
+
+        convert_time : int
+            The conversion time per channel in uS
+
+        baudrate : int
+
+        chunk : int, optional
+            The most samples written at once
+
+        calibrations : dict, optional
+            The keys are adc channels, and the values are the (gain, offset) applied to their readings
+        """
+        super().__init__(name="RawCaptureWriter", daemon=True)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.chunk = chunk
+        self.samples = 0
+        self.dropped = 0
+        self.reader = None
+        self._abort = threading.Event()
+
+        start = datetime.now()
+        calibrations = calibrations or dict()
+        self.meta = {"channels": list(channels),
+                     "convert_time_us": convert_time,
+                     "sample_period_s": convert_time*1e-6*len(channels),
+                     "baudrate": baudrate,
+                     "start_time": start.isoformat(),
+                     "start_timestamp": start.timestamp(),
+                     "dtype": ">u2",
+                     "scaling": {"full_scale_mV": FULL_SCALE_MV, "counts": COUNTS, "offset_mV": OFFSET_MV},
+                     # JSON keys are strings
+                     "calibration": {str(ac): {"gain": float(calibrations.get(ac, (1.0, 0.0))[0]),
+                                               "offset_mV": float(calibrations.get(ac, (1.0, 0.0))[1])}
+                                     for ac in channels},
+                     "samples": 0,
+                     "dropped": 0,
+                     "complete": False}
+        self._file = open(self.path, "wb")
+        self._write_sidecar()
+
+    def _write_sidecar(self):
+        with open(sidecar_path(self.path), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def follow(self, reader):
+        """Starts writing everything the reader puts in its ring buffer
+
+        Parameters
+        ----------
+        reader : SerialReader
+            As returned by `FastDAC.start_SPEC_ANA`
+        """
+        self.reader = reader
+        self.start()
+
+    def run(self):
+        ring = self.reader.ring
+        cursor = ring.cursor()
+        scratch = np.empty(self.chunk, dtype=ring.dtype)
+        while not self._abort.is_set():
+            ended = ring.closed
+            raw = cursor.read(out=scratch)
+            if len(raw):
+                # the samples are still in the FastDAC's big endian byte order
+                self._file.write(raw)
+                self.samples += len(raw)
+            elif ended:
+                break
+            else:
+                cursor.wait(0.05)
+        self.dropped = cursor.dropped
+
+    def close(self, complete=True, stats=None):
+        """Waits for the rest of the stream to be written (or stops at once if the capture failed), and completes the sidecar
+
+        Parameters
+        ----------
+        complete : bool, optional
+            Whether the capture finished normally
+
+        stats : AcquisitionStats, optional
+            Stored under "stats" in the sidecar
+        """
+        if not complete:
+            self._abort.set()
+        if self.is_alive():
+            self.join()
+        self._file.close()
+        self.meta.update(samples=self.samples, dropped=self.dropped,
+                         complete=complete and self.dropped == 0)
+        if stats is not None:
+            self.meta["stats"] = stats.as_dict()
+        self._write_sidecar()
+
+
+class LazyChannel():
+
+    def __init__(self, raw, scaling, gain=1.0, offset=0.0):
+        """The readings of one channel of a `RawCapture`. Indexing converts only the selected samples to mV.
+
+        Parameters
+        ----------
+        raw : numpy array
+            A (memory mapped) strided view of the channel's raw samples
+
+        scaling : dict
+            As stored in the sidecar
+
+        gain : float, optional
+            The calibration gain of the channel
+
+        offset : float, optional
+            The calibration offset of the channel in mV
+        """
+        self.raw = raw
+        self.scaling = scaling
+        self.gain = gain
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, index):
+        counts = self.raw[index]
+        s = self.scaling
+        mV = (counts - 0) * s["full_scale_mV"] / s["counts"] + s["offset_mV"]
+        if self.gain != 1.0 or self.offset != 0.0:
+            mV = self.gain*mV + self.offset
+        return mV
+
+    def __array__(self, dtype=None, copy=None):
+        mV = self[:]
+        return mV if dtype is None else mV.astype(dtype)
+
+
+class RawCapture():
+
+    def __init__(self, path):
+        """Opens a capture written by `RawCaptureWriter`, without reading it into memory.
+
+        Parameters
+        ----------
+        path : str or Path
+            The .bin file
+        """
+        self.path = Path(path)
+        with open(sidecar_path(self.path)) as f:
+            self.meta = json.load(f)
+        self.channels = self.meta["channels"]
+        self.sample_period = self.meta["sample_period_s"]
+
+        n = len(self.channels)
+        size = self.path.stat().st_size // 2
+        if size:
+            raw = np.memmap(self.path, dtype=self.meta["dtype"], mode="r")
+        else:
+            raw = np.zeros(0, dtype=self.meta["dtype"])
+        steps = size // n
+        # one row per step, one column per channel
+        self.frames = raw[:steps*n].reshape(steps, n)
+
+    def __len__(self):
+        """The number of complete steps, i.e. samples per channel"""
+        return self.frames.shape[0]
+
+    def __getitem__(self, channel):
+        """The `LazyChannel` of an ADC channel"""
+        # captures written before calibrations were stored have none
+        calibration = self.meta.get("calibration", dict()).get(str(channel), dict())
+        return LazyChannel(self.frames[:, self.channels.index(channel)], self.meta["scaling"],
+                           calibration.get("gain", 1.0), calibration.get("offset_mV", 0.0))
+
+    def time(self, index=slice(None)):
+        """The time in seconds of the selected steps, relative to the start of the capture"""
+        return np.arange(len(self))[index]*self.sample_period
+
+
+def load(path):
+    """Opens a raw capture. See `RawCapture`.
+    """
+    return RawCapture(path)
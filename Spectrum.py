@@ -0,0 +1,141 @@
+"""
+This module estimates power spectral densities of FastDAC readings while they stream in.
+
+`StreamingWelch` computes the same estimate as `scipy.signal.welch`, but segment by segment as chunks arrive: only the running average and the last, incomplete segment of every channel are kept, so averaging any number of segments needs constant memory. The segments of all channels go through one batched FFT, and the cross-spectral density and coherence of channel pairs (e.g. to find pickup common to two ADC inputs) come from the same FFTs.
+"""
+import itertools
+import numpy as np
+from scipy import signal
+
+
+class StreamingWelch():
+
+    def __init__(self, fs, channels=[0, ], nperseg=256, noverlap=None, window="hann", average="mean", alpha=0.1, pairs=None):
+        """Makes a new, empty running PSD estimate.
+
+        Parameters
+        ----------
+        fs : float
+            The sampling frequency of every channel in Hz
+
+        channels : list, optional
+            The channels to estimate the PSD of
+
+        nperseg : int, optional
+            The length of every segment. Sets the frequency resolution to fs/nperseg.
+
+        noverlap : int, optional
+            The number of samples shared by consecutive segments. Defaults to nperseg//2, like `scipy.signal.welch`.
+
+        window : str or tuple, optional
+            Passed to `scipy.signal.get_window`
+
+        average : "mean" or "exponential", optional
+            "mean" weighs every segment equally, as `scipy.signal.welch` does. "exponential" weighs each new segment by alpha, so the estimate follows a changing spectrum.
+
+        alpha : float, optional
+            The weight of a new segment in the exponential average
+
+        pairs : list of tuples or True, optional
+            The channel pairs (a, b) to estimate the cross-spectral density and coherence of. True for every pair of channels.
+        """
+        assert average in ("mean", "exponential"), "average must be mean or exponential"
+        self.fs = fs
+        self.channels = list(channels)
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 2 if noverlap is None else noverlap
+        assert 0 <= self.noverlap < nperseg, "noverlap must be less than nperseg"
+        self.step = nperseg - self.noverlap
+        self.average = average
+        self.alpha = alpha
+
+        self.window = signal.get_window(window, nperseg)
+        # density scaling, as scipy.signal.welch
+        scale = np.full(nperseg // 2 + 1, 2.0/(fs*(self.window**2).sum()))
+        scale[0] /= 2
+        if nperseg % 2 == 0:
+            scale[-1] /= 2
+        self._scale = scale
+        self.frequencies = np.fft.rfftfreq(nperseg, 1/fs)
+
+        if pairs is True:
+            pairs = itertools.combinations(self.channels, 2)
+        self.pairs = [tuple(p) for p in (pairs or list())]
+        index = {c: i for i, c in enumerate(self.channels)}
+        self._pair_index = (np.array([index[a] for a, b in self.pairs], dtype=int),
+                            np.array([index[b] for a, b in self.pairs], dtype=int))
+
+        # number of segments averaged, the same for every channel
+        self.segments = 0
+        # one row per channel, and one per pair
+        self._psd = np.zeros((len(self.channels), len(self.frequencies)))
+        self._csd = np.zeros((len(self.pairs), len(self.frequencies)), dtype=complex)
+        # samples not yet covered by a complete segment
+        self._tail = [np.zeros(0) for c in self.channels]
+
+    def _segments(self, x, n):
+        """A (n, nperseg) view of the first n segments of x"""
+        return np.lib.stride_tricks.as_strided(
+            x, shape=(n, self.nperseg), strides=(self.step*x.strides[0], x.strides[0]), writeable=False)
+
+    def _accumulate(self, average, periodograms):
+        """Averages periodograms of shape (rows, segments, frequencies) into average, of shape (rows, frequencies), in place
+        """
+        m = periodograms.shape[1]
+        if self.average == "mean":
+            average += (periodograms.sum(axis=1) - m*average)/(self.segments + m)
+        else:
+            if self.segments == 0:
+                average[...] = periodograms[:, 0]
+                periodograms = periodograms[:, 1:]
+            a = self.alpha
+            k = periodograms.shape[1]
+            weights = a*(1 - a)**np.arange(k - 1, -1, -1)
+            average *= (1 - a)**k
+            average += weights @ periodograms
+
+    def append(self, chunk):
+        """Adds new readings of every channel, and averages every segment they complete
+
+        Parameters
+        ----------
+        chunk : dict
+            The keys are channels, and the values are numpy arrays of new readings in mV. The readings of a channel may be one sample longer or shorter than those of another.
+        """
+        x = [np.concatenate((tail, chunk[c])) for tail, c in zip(self._tail, self.channels)]
+        shortest = min(len(xc) for xc in x)
+        n = (shortest - self.noverlap) // self.step if shortest >= self.nperseg else 0
+        if n:
+            # (channels, segments, nperseg), through one FFT
+            segments = np.stack([self._segments(xc, n) for xc in x])
+            segments = segments - segments.mean(axis=2, keepdims=True)
+            spectra = np.fft.rfft(segments*self.window, axis=2)
+            self._accumulate(self._psd, (spectra.real**2 + spectra.imag**2)*self._scale)
+            if self.pairs:
+                a, b = self._pair_index
+                self._accumulate(self._csd, np.conj(spectra[a])*spectra[b]*self._scale)
+            self.segments += n
+        self._tail = [xc[n*self.step:].copy() for xc in x]
+
+    def restart(self):
+        """Starts new segments with the next readings, e.g. after a gap in the data. The average is kept.
+        """
+        self._tail = [np.zeros(0) for c in self.channels]
+
+    def psd(self, channel):
+        """Returns the averaged power spectral density of a channel in mV**2/Hz, at `frequencies`
+        """
+        return self._psd[self.channels.index(channel)].copy()
+
+    def csd(self, a, b):
+        """Returns the averaged cross-spectral density of channels a and b in mV**2/Hz, as `scipy.signal.csd(a, b)`
+        """
+        if (a, b) in self.pairs:
+            return self._csd[self.pairs.index((a, b))].copy()
+        assert (b, a) in self.pairs, "({}, {}) is not one of the pairs".format(a, b)
+        return np.conj(self._csd[self.pairs.index((b, a))])
+
+    def coherence(self, a, b):
+        """Returns the magnitude squared coherence of channels a and b, between 0 and 1, as `scipy.signal.coherence`
+        """
+        return np.abs(self.csd(a, b))**2/(self.psd(a)*self.psd(b))
@@ -0,0 +1,88 @@
+"""
+Tests of `FastDAC` against the `FastDACEmulator`, for the paths that must leave the instrument ready for the next command.
+
+Run with ``python -m pytest test_FastDAC.py". The emulator needs a pseudo-terminal, so these tests are skipped where there is none.
+"""
+import json
+import time
+import pytest
+
+pytest.importorskip("pty")
+
+from FastDACEmulator import FastDACEmulator
+from FastDAC import FastDAC
+from ADCTrace import ADCTrace
+
+
+@pytest.fixture
+def fd():
+    with FastDACEmulator(noise=0.0, pickup=(60.0, 0.0)) as emu:
+        fd = FastDAC(emu.port, 1750000, 1)
+        with fd.session():
+            yield fd
+
+
+def assert_in_step(fd):
+    """Checks that the next queries each get their own reply"""
+    assert fd.NOP() == "NOP"
+    assert fd.IDN() == "DAC-ADC_AD7734-AD5764_EMULATOR"
+    assert fd.NOP() == "NOP"
+
+
+def fail_after(monkeypatch, calls, error):
+    """Makes ADCTrace.append raise error on its calls-th call, as a failing consumer or a Ctrl+C would"""
+    append = ADCTrace.append
+    count = [0]
+
+    def failing(self, raw):
+        count[0] += 1
+        if count[0] == calls:
+            raise error
+        return append(self, raw)
+    monkeypatch.setattr(ADCTrace, "append", failing)
+
+
+def test_ramp_stream_closed_before_iterating(fd):
+    ramp = fd.iter_RAMP_AND_READ([0], [0], 2000, {0: [0, 100]}, block_steps=50)
+    ramp.close()
+    assert not ramp.reader.is_alive()
+    assert_in_step(fd)
+
+
+def test_ramp_stream_left_after_it_finished(fd):
+    ramp = fd.iter_RAMP_AND_READ([0], [0], 200, {0: [0, 100]}, block_steps=50)
+    for step_range, readings in ramp:
+        # a slow consumer: the whole ramp arrives before the first block is used
+        time.sleep(1)
+        assert not ramp.reader.is_alive()
+        break
+    ramp.close()
+    assert_in_step(fd)
+
+
+def test_ramp_stream_left_early(fd):
+    with fd.iter_RAMP_AND_READ([0], [0], 20000, {0: [0, 100]}, block_steps=50) as ramp:
+        for step_range, readings in ramp:
+            break
+    assert_in_step(fd)
+
+
+def test_spec_ana_error(fd, monkeypatch):
+    fail_after(monkeypatch, 2, RuntimeError("consumer failed"))
+    with pytest.raises(RuntimeError):
+        fd.SPEC_ANA([0, 1], 100000)
+    assert_in_step(fd)
+
+
+def test_read_vs_time_interrupted(fd, monkeypatch, tmp_path):
+    fail_after(monkeypatch, 2, KeyboardInterrupt())
+    rawpath = tmp_path / "capture.bin"
+    with pytest.raises(KeyboardInterrupt):
+        fd.read_vs_time(None, 10, [0], h5path=tmp_path / "capture.h5", rawpath=rawpath)
+    assert_in_step(fd)
+    # the writers were closed, as incomplete
+    with open(rawpath.with_suffix(".json")) as f:
+        assert not json.load(f)["complete"]
+    import h5py
+    with h5py.File(tmp_path / "capture.h5", "r") as f:
+        assert all(not group.attrs["complete"] for group in f.values())
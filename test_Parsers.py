@@ -0,0 +1,174 @@
+"""
+Tests of the stream parsers: `Acquisition.Demultiplexer` and `PIDFastDAC.PIDFrameParser`.
+
+Byte streams are built in memory, damaged on purpose (bytes deleted, inserted or overwritten) and fed in pieces split at random points, and the decoded values and the dropped/skipped counts are checked against what was sent.
+
+Run with ``python -m pytest test_Parsers.py".
+"""
+import struct
+import numpy as np
+from Acquisition import Demultiplexer
+from PIDFastDAC import PIDFrameParser, PID_FRAME, PID_SYNC
+
+
+def pieces(data, rng, most=37):
+    """Splits data at random points, into pieces of 0 to most bytes"""
+    cuts = np.cumsum(rng.integers(0, most + 1, len(data)))
+    cuts = cuts[cuts < len(data)]
+    return [data[a:b] for a, b in zip(np.r_[0, cuts], np.r_[cuts, len(data)])]
+
+
+def joined(chunks, channels):
+    """Concatenates the dictionaries returned by Demultiplexer, channel by channel"""
+    return {ac: np.concatenate([c[ac] for c in chunks]) for ac in channels}
+
+
+def test_demultiplexer_random_splits():
+    rng = np.random.default_rng(1)
+    channels = [0, 3, 5]
+    steps = 1000
+    # sample i is i, so every channel is easy to predict
+    samples = np.arange(steps*len(channels), dtype=">u2")
+    for trial in range(10):
+        demux = Demultiplexer(channels)
+        chunks = [demux.feed(p) for p in pieces(samples.tobytes(), rng)]
+        # every piece yields whole steps only
+        assert all(len({len(v) for v in c.values()}) == 1 for c in chunks)
+        readings = joined(chunks, channels)
+        for k, ac in enumerate(channels):
+            assert np.array_equal(readings[ac], samples[k::len(channels)])
+        assert demux.pending == 0
+        assert demux.skipped == 0
+        assert demux.position == len(samples)
+
+
+def test_demultiplexer_gap():
+    channels = [0, 1, 2]
+    n = len(channels)
+    samples = np.arange(300, dtype=">u2")
+    demux = Demultiplexer(channels)
+    # samples 100 to 204 were lost, in the middle of a step on either side
+    first = demux.split(samples[:100], 0)
+    second = demux.split(samples[205:], 205)
+    readings = joined([first, second], channels)
+    # steps 0..32 before the gap, and 69..99 after it
+    kept = np.r_[np.arange(0, 33), np.arange(69, 100)]
+    for k, ac in enumerate(channels):
+        assert np.array_equal(readings[ac], kept*n + k)
+    # one sample of step 33 held back, and samples 205 and 206 of step 68
+    assert demux.skipped == 100 % n + (-205 % n)
+    assert demux.pending == 0
+
+
+def test_demultiplexer_gap_within_held_back_step():
+    channels = [0, 1]
+    samples = np.arange(20, dtype=">u2")
+    demux = Demultiplexer(channels)
+    demux.split(samples[:5], 0)
+    # a gap that ends on a step boundary only throws away the held back sample
+    readings = demux.split(samples[6:], 6)
+    assert np.array_equal(readings[0], np.arange(6, 20, 2))
+    assert np.array_equal(readings[1], np.arange(7, 20, 2))
+    assert demux.skipped == 1
+
+
+def make_frames(n, rng):
+    """n PID frames, some with the sync bytes inside their floats"""
+    frames = np.zeros(n, dtype=PID_FRAME)
+    frames["pv"] = rng.normal(0, 100, n)
+    frames["co"] = rng.normal(0, 100, n)
+    # floats whose bytes contain, or end with, the sync bytes
+    tricky = np.array([struct.unpack("<f", b)[0] for b in
+                       (b"\xa5\x5a\xa5\x5a", b"\x00\x00\xa5\x5a", b"\x5a\xa5\x5a\x00")], dtype="<f4")
+    frames["pv"][::7] = tricky[np.arange(0, n, 7) % 3]
+    frames["co"][3::11] = tricky[np.arange(3, n, 11) % 3]
+    frames["sync"] = tuple(PID_SYNC)
+    return frames
+
+
+def decode(stream, rng=None):
+    """Feeds stream to a new parser, in random pieces if rng is given, and returns (frames, parser)"""
+    parser = PIDFrameParser()
+    parts = [stream] if rng is None else pieces(stream, rng)
+    frames = np.concatenate([parser.feed(p) for p in parts])
+    return frames, parser
+
+
+def same(decoded, frames):
+    return np.array_equal(decoded.view(np.uint8), frames.view(np.uint8))
+
+
+def test_pid_parser_clean_stream():
+    rng = np.random.default_rng(2)
+    frames = make_frames(500, rng)
+    for trial in range(10):
+        decoded, parser = decode(frames.tobytes(), rng)
+        assert same(decoded, frames)
+        assert parser.dropped == 0
+        assert parser.skipped == 0
+        assert parser.pending == 0
+        assert parser.frames == len(frames)
+
+
+def test_pid_parser_corrupt_sync_bytes():
+    rng = np.random.default_rng(3)
+    frames = make_frames(200, rng)
+    stream = bytearray(frames.tobytes())
+    size = PID_FRAME.itemsize
+    # the sync bytes of frame 50 are damaged, but no byte is lost
+    stream[50*size + size - 2] = 0x00
+    for parts in (None, rng):
+        decoded, parser = decode(bytes(stream), parts)
+        assert same(decoded, np.delete(frames, 50))
+        assert parser.dropped == 1
+        assert parser.skipped == size
+
+
+def test_pid_parser_deleted_bytes():
+    rng = np.random.default_rng(4)
+    frames = make_frames(200, rng)
+    size = PID_FRAME.itemsize
+    for frame in (0, 7, 77, 150):
+        for lost in (1, 3, 6):
+            stream = bytearray(frames.tobytes())
+            # bytes lost from the floats of one frame
+            del stream[frame*size + 2:frame*size + 2 + lost]
+            for parts in (None, rng):
+                decoded, parser = decode(bytes(stream), parts)
+                assert same(decoded, np.delete(frames, frame)), (frame, lost)
+                assert parser.dropped == 1
+                assert parser.skipped == size - lost
+
+
+def test_pid_parser_inserted_bytes():
+    rng = np.random.default_rng(5)
+    frames = make_frames(200, rng)
+    size = PID_FRAME.itemsize
+    # junk and the frames counted as dropped for it: half a frame or more of
+    # junk, or junk ending on the sync bytes, cannot be told apart from what is
+    # left of a lost frame
+    for junk, dropped in ((b"\x01", 0), (b"\xa5\x5a", 1), (b"\x00\xa5\x5a\x00", 0), (b"\x00\xa5\x5a\x00\xa5", 1)):
+        stream = bytearray(frames.tobytes())
+        # junk between frames 40 and 41
+        stream[41*size:41*size] = junk
+        for parts in (None, rng):
+            decoded, parser = decode(bytes(stream), parts)
+            assert same(decoded, frames), junk
+            assert parser.dropped == dropped
+            assert parser.skipped == len(junk)
+
+
+def test_pid_parser_several_faults():
+    rng = np.random.default_rng(6)
+    frames = make_frames(300, rng)
+    size = PID_FRAME.itemsize
+    stream = bytearray(frames.tobytes())
+    # from the end, so the offsets stay valid
+    del stream[250*size + 4:250*size + 9]
+    stream[200*size + size - 1] = 0x00
+    stream[100*size:100*size] = b"\xff\xff\xff"
+    del stream[20*size:20*size + 1]
+    decoded, parser = decode(bytes(stream), rng)
+    assert same(decoded, np.delete(frames, [20, 200, 250]))
+    assert parser.dropped == 3
+    assert parser.skipped == (size - 1) + 3 + size + 5
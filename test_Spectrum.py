@@ -0,0 +1,74 @@
+"""
+Tests of `Spectrum.StreamingWelch` against `scipy.signal.welch`, `csd` and `coherence` on the whole signal.
+
+The channels are fed in chunks split at random points, and the chunks of one channel may be one sample longer or shorter than those of another, as a `Demultiplexer` hands them over.
+
+Run with ``python -m pytest test_Spectrum.py".
+"""
+import numpy as np
+from scipy import signal
+from Spectrum import StreamingWelch
+
+
+def feed(welch, x, rng, most=300):
+    """Appends the rows of x to welch in chunks, the ends of each chunk moved by -1, 0 or +1 sample per row"""
+    n = x.shape[1]
+    cuts = np.cumsum(rng.integers(3, most + 1, n))
+    cuts = cuts[cuts < n - 1]
+    # the chunks are at least 3 samples long, so the cuts stay in order
+    shifted = cuts + rng.integers(-1, 2, (len(x), len(cuts)))
+    bounds = [np.r_[0, s, n] for s in shifted]
+    for k in range(len(cuts) + 1):
+        welch.append({c: x[i, bounds[i][k]:bounds[i][k + 1]] for i, c in enumerate(welch.channels)})
+
+
+def signals(rng, n, fs):
+    """Three channels of noise, the first two sharing a sinusoid so that they are partly coherent"""
+    t = np.arange(n)/fs
+    common = 3*np.sin(2*np.pi*50*t)
+    x = rng.normal(0, 1, (3, n))
+    x[0] += common
+    x[1] += common + 0.5*x[0]
+    return x
+
+
+def test_psd_matches_welch():
+    rng = np.random.default_rng(7)
+    fs = 1000.0
+    x = signals(rng, 20000, fs)
+    for nperseg, noverlap in ((256, None), (255, 100), (64, 0)):
+        welch = StreamingWelch(fs, [0, 1, 2], nperseg, noverlap=noverlap)
+        feed(welch, x, rng)
+        f, expected = signal.welch(x, fs, nperseg=nperseg, noverlap=noverlap)
+        assert np.allclose(welch.frequencies, f)
+        for i, c in enumerate(welch.channels):
+            assert np.allclose(welch.psd(c), expected[i], rtol=1e-12, atol=0)
+
+
+def test_csd_and_coherence_match_scipy():
+    rng = np.random.default_rng(8)
+    fs = 1000.0
+    nperseg = 128
+    x = signals(rng, 10000, fs)
+    welch = StreamingWelch(fs, [0, 1, 2], nperseg, pairs=True)
+    feed(welch, x, rng)
+    assert welch.pairs == [(0, 1), (0, 2), (1, 2)]
+    for a, b in welch.pairs + [(1, 0)]:
+        f, csd = signal.csd(x[a], x[b], fs, nperseg=nperseg)
+        assert np.allclose(welch.csd(a, b), csd, rtol=1e-12, atol=0)
+        f, coherence = signal.coherence(x[a], x[b], fs, nperseg=nperseg)
+        assert np.allclose(welch.coherence(a, b), coherence, rtol=1e-12, atol=0)
+
+
+def test_shortest_channel_sets_the_segments():
+    rng = np.random.default_rng(9)
+    fs = 1000.0
+    nperseg = 100
+    x = signals(rng, 1050, fs)
+    welch = StreamingWelch(fs, [0, 1], nperseg)
+    # channel 1 is one sample short of the last segment
+    welch.append({0: x[0], 1: x[1, :-1]})
+    f, expected = signal.welch(x[:2, :-1], fs, nperseg=nperseg)
+    assert welch.segments == (len(x[1]) - 1 - nperseg//2)//(nperseg//2)
+    for i in range(2):
+        assert np.allclose(welch.psd(i), expected[i], rtol=1e-12, atol=0)